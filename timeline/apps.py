@@ -1,4 +1,4 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 from django.utils.translation import ugettext_lazy as _
 
 # Define your app configuration here.
@@ -11,4 +11,35 @@ class TimelineConfig(AppConfig):
 
     def ready(self):
         # Import your signal functions here.
-        import .signals
+        from . import signals
+        from django.contrib.contenttypes.fields import GenericRelation
+        from django.db.models.signals import post_delete, post_save
+        from .models import Timeline
+
+        # Models with a generic relation to Timeline can be shown in timelines.
+        self.timeline_models = {}
+        for model in apps.get_models():
+            for field in model._meta.get_fields():
+                if isinstance(field, GenericRelation) and field.related_model is Timeline:
+                    self.timeline_models[model._meta.model_name] = model
+        self.follow_installed = any(
+            'follow' in (app_config.name, app_config.label, app_config.name.split('.')[-1])
+            for app_config in apps.get_app_configs()
+        )
+        if self.follow_installed:
+            Follow = apps.get_model('follow', 'Follow')
+            post_save.connect(signals.follow_changed, sender=Follow, dispatch_uid='timeline_follow_changed')
+            post_delete.connect(signals.follow_changed, sender=Follow, dispatch_uid='timeline_follow_changed')
+        self._content_types = None
+
+    def content_types(self):
+        """
+        Return the content types of timeline models by model
+        name, loaded with one query the first time needed.
+        """
+        if self._content_types is None:
+            from django.contrib.contenttypes.models import ContentType
+
+            ctypes = ContentType.objects.get_for_models(*self.timeline_models.values())
+            self._content_types = {model._meta.model_name: ctype for model, ctype in ctypes.items()}
+        return self._content_types
@@ -0,0 +1,185 @@
+import datetime
+import random
+import time
+from collections import defaultdict
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import metrics
+from .forms import PostForm
+from .models import Comment, Post, Timeline
+from .views import show_posts_timeline
+
+# Create your benchmarks here.
+
+BENCHMARK_SETTINGS = {
+    'CACHES': {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'timeline-benchmarks',
+        },
+    },
+    'TEMPLATES': [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.locmem.Loader', {
+                    'post_timeline.html': (
+                        '{% load timeline_tags %}'
+                        '{% for post in posts %}'
+                        '{% post_comments_count post as count %}'
+                        '<article>{{ post.title }} {{ post.body }} {{ count }}</article>'
+                        '{% endfor %}'
+                    ),
+                }),
+            ],
+        },
+    }],
+}
+
+
+class Result(object):
+    """
+    Timings, queries and cache usage of one benchmark.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.queries = 0
+        # Lookups of cached values by key type, not counting generations.
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def percentile(self, percent):
+        timings = sorted(self.timings)
+        index = min(len(timings) - 1, int(round(percent / 100.0 * (len(timings) - 1))))
+        return timings[index] * 1000
+
+    def hit_ratio(self, key_type=None):
+        if key_type is None:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        else:
+            hits, misses = self.hits[key_type], self.misses[key_type]
+        lookups = hits + misses
+        return float(hits) / lookups if lookups else 0.0
+
+    def __str__(self):
+        lines = ['{name:<22} p50 {p50:8.2f}ms  p90 {p90:8.2f}ms  p99 {p99:8.2f}ms  '
+                 'queries/call {queries:6.1f}  cache hit ratio {ratio:5.1%}'.format(
+                     name=self.name, p50=self.percentile(50), p90=self.percentile(90),
+                     p99=self.percentile(99), queries=float(self.queries) / len(self.timings),
+                     ratio=self.hit_ratio())]
+        for key_type in sorted(set(self.hits) | set(self.misses)):
+            lines.append('    {key_type:<20} hits {hits:6d}  misses {misses:6d}  hit ratio {ratio:5.1%}'.format(
+                key_type=key_type, hits=self.hits[key_type], misses=self.misses[key_type],
+                ratio=self.hit_ratio(key_type)))
+        return '\n'.join(lines)
+
+
+def _cache_counters():
+    """
+    Return the cache hit and miss counters of the
+    metrics registry by outcome and key type.
+    """
+    registry = metrics.registry()
+    counters = registry.snapshot()['counters'] if registry is not None else {}
+    lookups = {'hit': defaultdict(int), 'miss': defaultdict(int)}
+    for name, value in counters.items():
+        parts = name.split('.', 2)
+        if len(parts) == 3 and parts[0] == 'cache' and parts[1] in lookups:
+            lookups[parts[1]][parts[2]] = value
+    return lookups
+
+
+def _measure(result, func, *args, **kwargs):
+    """
+    Run func once adding its timing, queries
+    and cache usage to result.
+    """
+    before = _cache_counters()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        result.timings.append(time.perf_counter() - start)
+    after = _cache_counters()
+    result.queries += len(queries)
+    for key_type, value in after['hit'].items():
+        result.hits[key_type] += value - before['hit'][key_type]
+    for key_type, value in after['miss'].items():
+        result.misses[key_type] += value - before['miss'][key_type]
+
+
+def seed(users, follows, posts, comments):
+    """
+    Populate the database with users, follow edges,
+    posts with their timeline entries and comments.
+    Follow edges need the follow app with a Follow
+    model holding follower and followee fields.
+    """
+    User.objects.bulk_create(User(username='bench{n}'.format(n=n)) for n in range(users))
+    authors = list(User.objects.filter(username__startswith='bench'))
+    if follows and apps.is_installed('follow'):
+        Follow = apps.get_model('follow', 'Follow')
+        edges = []
+        for follower in authors:
+            for followee in random.sample(authors, min(follows, len(authors))):
+                if followee != follower:
+                    edges.append(Follow(follower=follower, followee=followee))
+        Follow.objects.bulk_create(edges, batch_size=1000)
+    now = timezone.now()
+    Post.objects.bulk_create((
+        Post(author=author, title='Post {n}'.format(n=n), body='Benchmark post body.',
+             created=now - datetime.timedelta(minutes=random.randint(0, 60 * 24 * 30)))
+        for author in authors for n in range(posts)), batch_size=1000)
+    ctype = ContentType.objects.get_for_model(Post)
+    rows = Post.objects.filter(author__in=authors).values_list('pk', 'author', 'created')
+    Timeline.objects.bulk_create((
+        Timeline(content_type=ctype, object_id=pk, user_id=author, date=created)
+        for pk, author, created in rows.iterator()), batch_size=1000)
+    posts_id = list(Post.objects.filter(author__in=authors).values_list('pk', flat=True))
+    Comment.objects.bulk_create((
+        Comment(post_id=post_id, author=random.choice(authors), text='Benchmark comment.')
+        for post_id in posts_id for n in range(comments)), batch_size=1000)
+    Post.objects.filter(pk__in=posts_id).update(comments_count=comments, approved_comments_count=comments)
+    return authors
+
+
+def run(users=100, follows=20, posts=20, comments=5, iterations=200, seed_value=0):
+    """
+    Seed the database and measure the timeline hot paths.
+    The random generator is seeded with seed_value, so runs
+    with the same arguments seed and pick the same data.
+    Must run on an empty database with BENCHMARK_SETTINGS.
+    Cache hit ratios need the metrics registry sink.
+    Return the list of results.
+    """
+    random.seed(seed_value)
+    authors = seed(users, follows, posts, comments)
+    factory = RequestFactory()
+    results = [Result(name) for name in (
+        'get_timeline', 'get_posts_timeline', 'show_posts_timeline', 'PostForm.save', 'Post.delete')]
+    get_timeline, get_posts_timeline, render_timeline, save_post, delete_post = results
+    created = []
+    for iteration in range(iterations):
+        user = random.choice(authors)
+        _measure(get_timeline, Timeline.objects.get_timeline, model='post', user=user)
+        timeline = Timeline.objects.get_timeline(model='post', user=user)
+        _measure(get_posts_timeline, Post.objects.get_posts_timeline, user=user, timeline=timeline)
+        request = factory.get('/')
+        request.user = user
+        _measure(render_timeline, show_posts_timeline, request)
+        form = PostForm(data={'author': str(user.pk), 'title': 'Benchmark', 'body': 'New benchmark post.'})
+        if form.is_valid():
+            _measure(save_post, lambda: created.append(form.save(user=user, updated=False)))
+    for post in created:
+        _measure(delete_post, post.delete, user=post.author)
+    cache.clear()
+    return [result for result in results if result.timings]
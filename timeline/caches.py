@@ -1,72 +1,390 @@
-from django.core.cache import cache
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from . import metrics
 
 # Create your caches here.
 
 CACHE_KEYS = {
     'user_keys': {
         # user primary key (pk = user.pk)
-        'posts': 'tml_p-{pk}',
-        'timeline': 'tml_t-{pk}',
-        'posts_timeline': 'tml_pt-{pk}'
+        'posts': 'p-{pk}',
+        'timeline': 't-{pk}',
+        'posts_timeline': 'pt-{pk}',
+        'timeline_bucket': 'tb-{pk}',
+        'timeline_version': 'tv-{pk}',
     },
     'post_keys': {
         # post primary key (pk = post.pk)
-        'comments': 'tml_c-{pk}',
-        'approved_comments': 'tml_ac-{pk}',
-        'disapproved_comments': 'tml_dc-{pk}',
+        'comments': 'c-{pk}',
+        'approved_comments': 'ac-{pk}',
+        'disapproved_comments': 'dc-{pk}',
+        'post_fragment': 'pf-{pk}',
+    },
+    'app_keys': {
+        # one key for the whole app (pk = 0)
+        'pull_authors': 'pa-all',
+    },
+    'plain_keys': {
+        # user primary key (pk = user.pk), never versioned
+        'feed': 'f-{pk}',
+        'pull_author': 'pa-{pk}',
+        'replica_pin': 'rp-{pk}',
     },
 }
 
 
 CACHE_BUST = {
+    # Closed day buckets only change when past entries do,
+    # so they are busted apart with 'timeline_bucket'.
     'posts_timeline': [
         'posts',
         'timeline',
         'posts_timeline',
+        'timeline_version',
+    ],
+    # Caches of a follower, changing with the followees' content.
+    'followees': [
+        'timeline',
+        'posts_timeline',
+        'timeline_version',
+    ],
+    'followees_history': [
+        'timeline',
+        'posts_timeline',
+        'timeline_bucket',
+        'timeline_version',
     ],
     'comments': [
         'comments',
         'approved_comments',
         'disapproved_comments',
+        'post_fragment',
     ],
     'approved_comments': [
         'approved_comments',
+        'post_fragment',
     ],
     'disapproved_comments': [
         'disapproved_comments',
+        'post_fragment',
     ],
 }
 
 
+CACHE_TIMEOUTS = {
+    # seconds, overridden by settings.TIMELINE_CACHE_TIMEOUTS
+    'posts': 60 * 60,
+    'timeline': 60 * 60,
+    'posts_timeline': 60 * 60,
+    'timeline_bucket': 60 * 60 * 24 * 7,
+    'timeline_version': 60 * 60,
+    'comments': 60 * 60,
+    'approved_comments': 60 * 60,
+    'disapproved_comments': 60 * 60,
+    'post_fragment': 60 * 60,
+    'feed': 60 * 60 * 24,
+    'pull_author': None,
+}
+
+
+def cache_prefix():
+    """
+    Return the prefix shared by all timeline cache keys.
+    """
+    return getattr(settings, 'TIMELINE_CACHE_PREFIX', 'tml')
+
+
+def cache_timeout(key_type):
+    """
+    Return the timeout for a particular type of cached value.
+    """
+    timeouts = getattr(settings, 'TIMELINE_CACHE_TIMEOUTS', {})
+    return timeouts.get(key_type, CACHE_TIMEOUTS.get(key_type))
+
+
+def _base_key(key_type, pk):
+    """
+    Build the unversioned cache key for a type of cached value.
+    """
+    for keys in CACHE_KEYS.values():
+        if key_type in keys:
+            key = keys[key_type].format(pk=pk)
+            return '{prefix}_{key}'.format(prefix=cache_prefix(), key=key)
+    raise KeyError('Unknown cache key type {key_type}.'.format(key_type=key_type))
+
+
+def _version_key(key_type, pk):
+    """
+    Build the key holding the generation of a cached value.
+    """
+    return '{key}_v'.format(key=_base_key(key_type, pk))
+
+
+def _new_version():
+    """
+    Start a generation from the current time, so a lost
+    counter never resurrects values of an older generation.
+    Random low digits keep apart the generations started
+    in the same millisecond.
+    """
+    return int(time.time() * 1000) * 1000000 + random.randrange(1000000)
+
+
 def cache_bust(cache_types):
     """
     Bust the cache for a given type.
     The 'cache_types' parameters is a list
     of tuples (key_type, pk).
+    Busting increments the generation of the keys
+    instead of deleting them.
+    """
+    for key_type, pk in cache_types:
+        bust_types = CACHE_BUST.get(key_type, [key_type])
+        for to_bust in bust_types:
+            metrics.incr('cache.bust.{key_type}'.format(key_type=to_bust))
+            _bump_version(_version_key(to_bust, pk))
+
+
+def _bump_version(version_key):
+    """
+    Increment a generation, starting a new one if it was lost.
+    """
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        if not cache.add(version_key, _new_version(), None):
+            cache.incr(version_key)
+
+
+def cache_bust_many(cache_types):
+    """
+    Bust the cache for many (key_type, pk) tuples at once,
+    starting a new generation for each key once even if
+    several tuples share it, with one set_many per
+    settings.TIMELINE_CACHE_BUST_BATCH_SIZE keys.
     """
+    version_keys = set()
     for key_type, pk in cache_types:
-        bust_types = CACHE_BUST.get(key_type, None)
-        keys = [make_key(to_bust, pk) for to_bust in bust_types]
-        cache.delete_many(keys)
+        bust_types = CACHE_BUST.get(key_type, [key_type])
+        for to_bust in bust_types:
+            metrics.incr('cache.bust.{key_type}'.format(key_type=to_bust))
+            version_keys.add(_version_key(to_bust, pk))
+    version_keys = sorted(version_keys)
+    batch_size = getattr(settings, 'TIMELINE_CACHE_BUST_BATCH_SIZE', 500)
+    for start in range(0, len(version_keys), batch_size):
+        cache.set_many({version_key: _new_version() for version_key in version_keys[start:start + batch_size]}, None)
+
+
+_bust_executor = None
+_bust_slots = None
+_bust_lock = threading.Lock()
+
+
+def cache_bust_async(cache_types):
+    """
+    Bust the cache for many (key_type, pk) tuples in a background
+    thread. cache_types may also be a callable returning the
+    tuples, called in the background thread, so enumerating them
+    does not block the caller. The number of pending busts is
+    bounded by settings.TIMELINE_CACHE_BUST_QUEUE_SIZE; when the
+    queue is full the bust is dropped and the values expire with
+    their timeout.
+    Return True if the bust was queued.
+    """
+    global _bust_executor, _bust_slots
+    with _bust_lock:
+        if _bust_executor is None:
+            _bust_executor = ThreadPoolExecutor(max_workers=1)
+            _bust_slots = threading.BoundedSemaphore(getattr(settings, 'TIMELINE_CACHE_BUST_QUEUE_SIZE', 100))
+    if not _bust_slots.acquire(blocking=False):
+        return False
+    if callable(cache_types):
+        future = _bust_executor.submit(lambda: cache_bust_many(cache_types()))
+    else:
+        future = _bust_executor.submit(cache_bust_many, list(cache_types))
+    future.add_done_callback(lambda done: _bust_slots.release())
+    return True
 
 
 def make_key(key_type, pk):
     """
     Build the cache key for a particular type of cached value.
     """
-    key = CACHE_KEYS['user_keys'].get(key_type, None)
-    if key is None:
-        key = CACHE_KEYS['post_keys'].get(key_type)
-    key.format(pk=pk)
-    return key
+    key = _base_key(key_type, pk)
+    if key_type in CACHE_KEYS['plain_keys']:
+        return key
+    version_key = _version_key(key_type, pk)
+    version = cache.get(version_key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return '{key}.{version}'.format(key=key, version=version)
 
 
 def make_key_many(cache_types):
     """
-    Build the cache key for several cache values.
+    Build the cache key for several cache values
+    fetching their generations at once.
+    Return a dict mapping (key_type, pk) to key.
     """
+    version_keys = {}
     keys = {}
     for key_type, pk in cache_types:
-        key = make_key(key_type, pk)
-        keys.update({key_type: key})
+        if key_type in CACHE_KEYS['plain_keys']:
+            keys[(key_type, pk)] = _base_key(key_type, pk)
+        else:
+            version_keys[_version_key(key_type, pk)] = (key_type, pk)
+    versions = cache.get_many(version_keys.keys())
+    missing = {}
+    for version_key, cache_type in version_keys.items():
+        version = versions.get(version_key)
+        if version is None:
+            version = _new_version()
+            missing[version_key] = version
+        keys[cache_type] = '{key}.{version}'.format(key=_base_key(*cache_type), version=version)
+    for version_key, version in missing.items():
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+            cache_type = version_keys[version_key]
+            keys[cache_type] = '{key}.{version}'.format(key=_base_key(*cache_type), version=version)
     return keys
+
+
+def cache_get(key_type, key, backend=None):
+    """
+    Get a cached value counting the hit or miss.
+    """
+    value = (backend or cache).get(key)
+    outcome = 'miss' if value is None else 'hit'
+    metrics.incr('cache.{outcome}.{key_type}'.format(outcome=outcome, key_type=key_type))
+    return value
+
+
+def cache_get_many(key_type, keys, backend=None):
+    """
+    Get several cached values of one type counting
+    the hits and misses.
+    """
+    keys = list(keys)
+    values = (backend or cache).get_many(keys)
+    if values:
+        metrics.incr('cache.hit.{key_type}'.format(key_type=key_type), len(values))
+    if len(keys) > len(values):
+        metrics.incr('cache.miss.{key_type}'.format(key_type=key_type), len(keys) - len(values))
+    return values
+
+
+def cache_store(key, value, timeout, delta=0.0, backend=None):
+    """
+    Cache a value wrapped with its soft expiry time and the
+    seconds it took to compute. The entry outlives the soft
+    expiry by settings.TIMELINE_CACHE_STALE_SECONDS so it can
+    be served stale while it is recomputed.
+    """
+    stale = getattr(settings, 'TIMELINE_CACHE_STALE_SECONDS', 60)
+    if timeout is None:
+        envelope, hard_timeout = (value, None, delta), None
+    else:
+        envelope, hard_timeout = (value, time.time() + timeout, delta), timeout + stale
+    (backend or cache).set(key, envelope, hard_timeout)
+
+
+def cache_store_many(values, timeout, backend=None):
+    """
+    Cache several values computed at once.
+    """
+    stale = getattr(settings, 'TIMELINE_CACHE_STALE_SECONDS', 60)
+    if timeout is None:
+        envelopes = {key: (value, None, 0.0) for key, value in values.items()}
+        (backend or cache).set_many(envelopes, None)
+    else:
+        expiry = time.time() + timeout
+        envelopes = {key: (value, expiry, 0.0) for key, value in values.items()}
+        (backend or cache).set_many(envelopes, timeout + stale)
+
+
+def cache_value(envelope):
+    """
+    Return the value wrapped in a cached entry, even if stale.
+    """
+    if envelope is None:
+        return None
+    value, expiry, delta = envelope
+    return value
+
+
+def _is_fresh(envelope):
+    """
+    Check the soft expiry of a cached entry. Entries expire
+    early at random, more likely as the expiry gets closer and
+    the longer they take to compute, so a single reader
+    usually recomputes them before they expire.
+    """
+    value, expiry, delta = envelope
+    if expiry is None:
+        return True
+    beta = getattr(settings, 'TIMELINE_CACHE_EARLY_EXPIRATION', 1.0)
+    return time.time() - delta * beta * math.log(1.0 - random.random()) < expiry
+
+
+def cached_read(key_type, key, compute, timeout, backend=None):
+    """
+    Read a cached value, computing and caching it on a miss.
+    Only one reader at a time computes a value, holding a lock
+    added to the cache; the others serve the stale value if any,
+    or wait up to settings.TIMELINE_CACHE_LOCK_WAIT seconds for
+    the new one before computing it themselves.
+    """
+    backend = backend or cache
+    lock_key = '{key}:lock'.format(key=key)
+    lock_timeout = getattr(settings, 'TIMELINE_CACHE_LOCK_TIMEOUT', 10)
+    envelope = cache_get(key_type, key, backend)
+    if envelope is not None and _is_fresh(envelope):
+        return cache_value(envelope)
+    deadline = time.time() + getattr(settings, 'TIMELINE_CACHE_LOCK_WAIT', 1.0)
+    while True:
+        if backend.add(lock_key, True, lock_timeout):
+            try:
+                start = time.time()
+                value = compute()
+                cache_store(key, value, timeout, time.time() - start, backend)
+                return value
+            finally:
+                backend.delete(lock_key)
+        if envelope is not None:
+            metrics.incr('cache.stale.{key_type}'.format(key_type=key_type))
+            return cache_value(envelope)
+        if time.time() > deadline:
+            metrics.incr('cache.lock_timeout.{key_type}'.format(key_type=key_type))
+            return compute()
+        time.sleep(0.05)
+        envelope = backend.get(key)
+        if envelope is not None:
+            return cache_value(envelope)
+
+
+def pack(ids, stamp=None):
+    """
+    Build the compact payload cached for an evaluated query:
+    the ordered primary keys and an optional row version stamp
+    (the newest date of the rows).
+    """
+    return (list(ids), stamp)
+
+
+def feed_cache():
+    """
+    Return the cache holding the materialized feeds.
+    Feeds are never busted, so a non evicting backend
+    can be configured with settings.TIMELINE_FEED_CACHE.
+    """
+    alias = getattr(settings, 'TIMELINE_FEED_CACHE', 'default')
+    return caches[alias]
@@ -0,0 +1,29 @@
+import asyncio
+
+from django.db import close_old_connections
+
+from . import routers
+
+# Create your concurrency helpers here.
+
+def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking function in the default executor of the
+    event loop and return an awaitable of its result, so
+    several cache and database round trips can be awaited
+    concurrently with asyncio.gather. The worker thread reads
+    from the database picked for the caller, and closes its
+    database connections once stale.
+    """
+    state = routers.request_state()
+
+    def call():
+        routers.restore_state(state)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            routers.end_request()
+            close_old_connections()
+
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, call)
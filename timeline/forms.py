@@ -1,7 +1,11 @@
 from django import forms
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 
 from .caches import cache_bust
+from .media import process_image
+from .routers import pin_to_primary, write_alias
 from .models import Comment, Post, Timeline
 
 # Create your forms here.
@@ -29,8 +33,14 @@ class CommentForm(forms.ModelForm):
             comment = super(CommentForm, self).save(commit=False)
             comment.post = kwargs.get('post')
             comment.author = user
-            comment.save()
+            with transaction.atomic(using=write_alias()):
+                comment.save()
+                if comment.approved:
+                    Post.objects.update_comments_count(comment.post, approved=1)
+                else:
+                    Post.objects.update_comments_count(comment.post, disapproved=1)
             cache_bust([('comments', comment.post.pk)])
+            pin_to_primary(user)
             return comment
         return False
 
@@ -72,9 +82,21 @@ class PostForm(forms.ModelForm):
                 post.author = user
             if updated:
                 post.last_updated = timezone.now()
+                post.version = F('version') + 1
+            image_changed = 'image' in self.changed_data
+            if image_changed:
+                post.image_thumbnail = post.image_medium = ''
             post.save()
+            if updated:
+                post.refresh_from_db(fields=['version'])
+            if image_changed:
+                transaction.on_commit(lambda: process_image(post), using=write_alias())
             if not updated:
                 Timeline.objects.add_to_timeline(instance=post, user=user)
+            else:
+                cache_bust([('post_fragment', post.pk)])
+                Timeline.objects.bust_followers(user=user, key_type='timeline_version')
             cache_bust([('posts_timeline', user.pk)])
+            pin_to_primary(user)
             return post
         return False
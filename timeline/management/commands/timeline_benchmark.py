@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from ...benchmarks import BENCHMARK_SETTINGS, run
+
+# Create your commands here.
+
+class Command(BaseCommand):
+    help = 'Benchmark the timeline read and write paths on a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Number of users to seed.')
+        parser.add_argument('--follows', type=int, default=20, help='Followees per user.')
+        parser.add_argument('--posts', type=int, default=20, help='Posts per user.')
+        parser.add_argument('--comments', type=int, default=5, help='Comments per post.')
+        parser.add_argument('--iterations', type=int, default=200, help='Measured calls per path.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+
+    def handle(self, *args, **options):
+        # Runs on the test database of the default connection,
+        # which is in memory with the SQLite backend.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**BENCHMARK_SETTINGS):
+                results = run(
+                    users=options['users'],
+                    follows=options['follows'],
+                    posts=options['posts'],
+                    comments=options['comments'],
+                    iterations=options['iterations'],
+                    seed_value=options['seed'],
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        for result in results:
+            self.stdout.write(str(result))
@@ -0,0 +1,175 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...media import remove_media
+from ...models import Post
+
+# Create your commands here.
+
+VARIANT_FIELDS = {
+    # variant file suffix: post field storing its path
+    '-thumbnail.jpg': 'image_thumbnail',
+    '-medium.jpg': 'image_medium',
+}
+
+
+class Command(BaseCommand):
+    help = 'Remove post images and image variants no longer referenced by any post.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of files checked against the database per query.',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60 * 60,
+            help='Seconds since last modification before a file can be removed.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report orphaned files without removing them.',
+        )
+
+    def _scan_dir(self, directory, suffixes=None):
+        """
+        Stream the files of a directory.
+        """
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if suffixes is None or entry.name.endswith(suffixes):
+                    yield entry
+
+    def _scan_subdirs(self, directory):
+        """
+        Stream the subdirectories of a directory.
+        """
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry
+
+    def _scan_images(self, media_root):
+        """
+        Stream the files under MEDIA_ROOT/<user>/images/posts/.
+        """
+        with os.scandir(media_root) as users:
+            for user in users:
+                if user.name == 'variants' or not user.is_dir(follow_symlinks=False):
+                    continue
+                yield from self._scan_dir(os.path.join(user.path, 'images', 'posts'))
+
+    def _scan_variants(self, media_root):
+        """
+        Stream the files under MEDIA_ROOT/variants/<xx>/<xx>/.
+        """
+        suffixes = tuple(VARIANT_FIELDS)
+        for level_one in self._scan_subdirs(os.path.join(media_root, 'variants')):
+            for level_two in self._scan_subdirs(level_one.path):
+                yield from self._scan_dir(level_two.path, suffixes)
+
+    def _chunks(self, entries, media_root, chunk_size, min_age):
+        """
+        Group the files old enough to be removed in chunks
+        of {relative path: full path}.
+        """
+        deadline = time.time() - min_age
+        chunk = {}
+        for entry in entries:
+            if entry.stat(follow_symlinks=False).st_mtime > deadline:
+                continue
+            name = os.path.relpath(entry.path, media_root).replace(os.sep, '/')
+            chunk[name] = entry.path
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = {}
+        if chunk:
+            yield chunk
+
+    def _collect(self, chunks, referenced, media_root, dry_run):
+        """
+        Remove the files of each chunk not referenced by any post.
+        Return the number of orphaned files.
+        """
+        orphans_count = 0
+        for chunk in chunks:
+            live = referenced(list(chunk))
+            orphans = [path for name, path in chunk.items() if name not in live]
+            orphans_count += len(orphans)
+            if dry_run:
+                for path in orphans:
+                    self.stdout.write(path)
+            else:
+                remove_media(orphans, media_root)
+        return orphans_count
+
+    def _referenced_images(self, names):
+        """
+        Return the image paths still stored on posts, matching
+        the absolute paths saved before they were stored
+        relative to MEDIA_ROOT too.
+        """
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        absolute = {os.path.join(media_root, name): name for name in names}
+        images = Post.objects.filter(Q(image__in=names) | Q(image__in=list(absolute))).values_list('image', flat=True)
+        return {absolute.get(image, image) for image in images.iterator()}
+
+    def _referenced_variants(self, names):
+        """
+        Return the variant paths still stored on posts.
+        """
+        query = Q()
+        for field in VARIANT_FIELDS.values():
+            query |= Q(**{'{field}__in'.format(field=field): names})
+        referenced = set()
+        for paths in Post.objects.filter(query).values_list(*VARIANT_FIELDS.values()).iterator():
+            referenced.update(paths)
+        return referenced
+
+    def _prune_dirs(self, media_root):
+        """
+        Remove the empty directories left under MEDIA_ROOT/<user>/,
+        going up only once the directory below was removed.
+        """
+        for user in self._scan_subdirs(media_root):
+            posts = os.path.join(user.path, 'images', 'posts')
+            if user.name == 'variants' or not os.path.isdir(posts):
+                continue
+            for directory in (posts, os.path.dirname(posts), user.path):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+
+    def handle(self, *args, **options):
+        media_root = getattr(settings, 'MEDIA_ROOT', None)
+        if not media_root or not os.path.isdir(media_root):
+            raise CommandError('MEDIA_ROOT is not an existing directory.')
+        chunk_size, min_age, dry_run = options['chunk_size'], options['min_age'], options['dry_run']
+        images = self._chunks(self._scan_images(media_root), media_root, chunk_size, min_age)
+        images_count = self._collect(images, self._referenced_images, media_root, dry_run)
+        variants = self._chunks(self._scan_variants(media_root), media_root, chunk_size, min_age)
+        variants_count = self._collect(variants, self._referenced_variants, media_root, dry_run)
+        if not dry_run:
+            self._prune_dirs(media_root)
+        action = 'Found' if dry_run else 'Removed'
+        self.stdout.write('{action} {images} orphaned images and {variants} orphaned variants.'.format(
+            action=action, images=images_count, variants=variants_count))
@@ -0,0 +1,89 @@
+import csv
+import itertools
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ...models import Post
+
+# Create your commands here.
+
+class Command(BaseCommand):
+    help = 'Import posts from a JSONL or CSV file with author, title, body and created fields.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import.')
+        parser.add_argument(
+            '--format',
+            choices=['jsonl', 'csv'],
+            default=None,
+            help='File format, guessed from the extension by default.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of posts written per transaction.',
+        )
+
+    def _read(self, source, file_format):
+        """
+        Stream the raw records of the file.
+        """
+        if file_format == 'csv':
+            for row in csv.DictReader(source):
+                yield row
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _parse_date(self, value):
+        if not value:
+            return None
+        date = parse_datetime(value)
+        if date is None:
+            raise CommandError('Invalid date {value}.'.format(value=value))
+        if settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.utc)
+        return date
+
+    def _records(self, rows, chunk_size):
+        """
+        Turn raw records into post fields, resolving
+        the authors usernames with one query per chunk.
+        """
+        authors = {}
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            usernames = set(row['author'] for row in chunk) - set(authors)
+            if usernames:
+                authors.update(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+            for row in chunk:
+                if row['author'] not in authors:
+                    raise CommandError('Unknown author {author}.'.format(author=row['author']))
+                record = {
+                    'author_id': authors[row['author']],
+                    'title': row.get('title') or '',
+                    'body': row['body'],
+                    'last_updated': self._parse_date(row.get('last_updated')),
+                }
+                created = self._parse_date(row.get('created'))
+                if created is not None:
+                    record['created'] = created
+                yield record
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        chunk_size = options['chunk_size']
+        with open(path, newline='', encoding='utf-8') as source:
+            records = self._records(self._read(source, file_format), chunk_size)
+            imported = Post.objects.bulk_import(records, chunk_size=chunk_size)
+        self.stdout.write('Imported {imported} posts.'.format(imported=imported))
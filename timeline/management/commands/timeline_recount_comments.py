@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from ...caches import cache_bust_many
+from ...models import Post
+
+# Create your commands here.
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized comment counters of posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of posts recounted per query.',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        recounted = 0
+        last_pk = 0
+        while True:
+            posts_id = list(Post.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not posts_id:
+                break
+            last_pk = posts_id[-1]
+            recounted += Post.objects.recount_comments(posts_id)
+            cache_bust_many([('comments', pk) for pk in posts_id])
+        self.stdout.write('Recounted comments of {recounted} posts.'.format(recounted=recounted))
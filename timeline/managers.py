@@ -1,123 +1,392 @@
+import asyncio
+import bisect
 import datetime
+import heapq
+import itertools
+from collections import defaultdict
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from .models import Follow
-from .caches import cache_bust, make_key, make_key_many
+from . import metrics
+from .concurrency import run_sync
+from .caches import (
+    cache_bust, cache_bust_async, cache_bust_many, cache_get, cache_get_many, cache_store,
+    cache_store_many, cache_timeout, cache_value, cached_read, feed_cache, make_key, make_key_many, pack,
+)
+from .metrics import instrumented
+from .routers import write_alias
 
 # Create your managers here.
 
+def _cached_ids(key_type, pk, queryset, stamp_field=None):
+    """
+    Return the ordered primary keys of a queryset and
+    an optional row version stamp, caching the compact
+    evaluated payload instead of the queryset itself.
+    """
+    def compute():
+        with metrics.timer('query.{key_type}'.format(key_type=key_type)):
+            if stamp_field is None:
+                rows = [(pk, None) for pk in queryset.values_list('pk', flat=True)]
+            else:
+                rows = list(queryset.values_list('pk', stamp_field))
+        stamps = [stamp for pk, stamp in rows if stamp is not None]
+        return pack([pk for pk, stamp in rows], max(stamps) if stamps else None)
+
+    return cached_read(key_type, make_key(key_type, pk), compute, cache_timeout(key_type))
+
+
+def _hydrate(queryset, ids):
+    """
+    Fetch the instances for a list of primary keys
+    in one query, keeping the list order.
+    """
+    with metrics.timer('hydrate.{model}'.format(model=queryset.model._meta.model_name)):
+        instances = queryset.in_bulk(ids) if ids else {}
+    return [instances[pk] for pk in ids if pk in instances]
+
+
 class CommentManager(models.Manager):
     """
     Comment model manager.
     """
 
+    @instrumented
+    def _comment_ids(self, key_type, post, **filters):
+        """
+        Get cached post comments id's.
+        """
+        queryset = self.filter(post__pk=post.pk, **filters).order_by('-created')
+        ids, stamp = _cached_ids(key_type, post.pk, queryset, 'created')
+        return ids
+
+    @instrumented
     def comments(self, post):
         """
         Get all post comments.
         """
-        key = make_key('comments', post.pk)
-        comments = cache.get(key)
-        if comments is None:
-            comments = self.filter(post__pk=post.pk).order_by('-created')
-            cache.set(key, comments)
+        ids = self._comment_ids('comments', post)
+        comments = _hydrate(self.select_related('author'), ids)
         return comments
 
+    @instrumented
     def comments_count(self, post):
         """
         Return a count of all post comments.
         """
-        count = self.comments(post).count()
+        count = post.comments_count
         return count
 
+    @instrumented
+    def counts_for_posts(self, posts):
+        """
+        Return a dict with the count of all comments
+        of several posts.
+        """
+        counts = {post.pk: post.comments_count for post in posts}
+        return counts
+
+    @instrumented
+    async def acomments(self, post):
+        """
+        Get all post comments without blocking the event loop.
+        """
+        comments = await run_sync(self.comments, post)
+        return comments
+
+    @instrumented
+    async def acomments_for_posts(self, posts, limit=None):
+        """
+        Return a dict with the comments of several posts
+        without blocking the event loop.
+        """
+        comments = await run_sync(self.comments_for_posts, posts, limit)
+        return comments
+
+    @instrumented
+    def comments_for_posts(self, posts, limit=None):
+        """
+        Return a dict with the comments of several posts,
+        up to limit comments per post, fetching the missing
+        id's lists with one query and all the comments
+        with one more.
+        """
+        keys = make_key_many([('comments', post.pk) for post in posts])
+        cached = cache_get_many('comments', keys.values())
+        ids = {}
+        missing = []
+        for (key_type, pk), key in keys.items():
+            if key in cached:
+                ids[pk], stamp = cache_value(cached[key])
+            else:
+                missing.append(pk)
+        if missing:
+            rows = {pk: [] for pk in missing}
+            queryset = self.filter(post__pk__in=missing).order_by('-created')
+            for pk, post_pk, created in queryset.values_list('pk', 'post', 'created'):
+                rows[post_pk].append((pk, created))
+            payloads = {}
+            for post_pk, comments in rows.items():
+                payloads[keys[('comments', post_pk)]] = pack([pk for pk, created in comments],
+                                                             comments[0][1] if comments else None)
+                ids[post_pk] = [pk for pk, created in comments]
+            cache_store_many(payloads, cache_timeout('comments'))
+        if limit is not None:
+            ids = {post_pk: comment_ids[:limit] for post_pk, comment_ids in ids.items()}
+        comments = self.select_related('author').in_bulk([pk for comment_ids in ids.values() for pk in comment_ids])
+        return {post_pk: [comments[pk] for pk in comment_ids if pk in comments]
+                for post_pk, comment_ids in ids.items()}
+
+    @instrumented
     def approved_comments(self, post):
         """
         Get post approved comments.
         """
-        key = make_key('approved_comments', post.pk)
-        approved = cache.get(key)
-        if approved is None:
-            approved = self.filter(post__pk=post.pk, approved=True).order_by('-created')
-            cache.set(key, approved)
+        ids = self._comment_ids('approved_comments', post, approved=True)
+        approved = _hydrate(self.select_related('author'), ids)
         return approved
 
+    @instrumented
     def approved_comments_count(self, post):
         """
         Return a count of all post approved comments.
         """
-        count = self.approved_comments(post).count()
+        count = post.approved_comments_count
         return count
 
+    @instrumented
     def disapproved_comments(self, post):
         """
         Get post disapproved comments.
         """
-        key = make_key('disapproved_comments', post.pk)
-        disapproved = cache.get(key)
-        if disapproved is None:
-            disapproved = self.filter(post__pk=post.pk, approved=False).order_by('-created')
-            cache.set(key, disapproved)
+        ids = self._comment_ids('disapproved_comments', post, approved=False)
+        disapproved = _hydrate(self.select_related('author'), ids)
         return disapproved
 
+    @instrumented
     def disapproved_comments_count(self, post):
         """
         Return a count of all post disapproved comments.
         """
-        count = self.disapproved_comments(post).count()
+        count = post.disapproved_comments_count
         return count
 
-    def delete_disapproved(self, post):
+    @instrumented
+    def delete_disapproved(self, post, user):
         """
         Remove disapproved comments for a post.
         """
         if user.is_authenticated() and user == post.author:
-            disapproved = self.disapproved_comments(post)
-            if disapproved:
-                disapproved.delete()
-                cache_bust([('disapproved_comments', post.pk)])
+            with transaction.atomic(using=write_alias()):
+                deleted, rows = self.filter(post__pk=post.pk, approved=False).delete()
+                if deleted:
+                    post.__class__.objects.update_comments_count(post, disapproved=-deleted)
+            if deleted:
+                cache_bust([('comments', post.pk)])
             return True
         return False
 
+    @instrumented
+    def moderate(self, action, user, comments_id=None, author=None):
+        """
+        Approve, disapprove or delete at once a set of comments
+        given by id's, or all the comments of an author.
+        Only comments on user's posts are moderated, unless
+        user is staff.
+        Counters and caches of the affected posts are
+        refreshed once per post.
+        Return the number of moderated comments.
+        """
+        if action not in ('approve', 'disapprove', 'delete'):
+            raise ValidationError('Unknown moderation action {action}.'.format(action=action))
+        if not user.is_authenticated() or (comments_id is None and author is None):
+            return 0
+        using = self._db or router.db_for_write(self.model)
+        comments = self.using(using)
+        if comments_id is not None:
+            comments = comments.filter(pk__in=comments_id)
+        if author is not None:
+            comments = comments.filter(author=author)
+        if not user.is_staff:
+            comments = comments.filter(post__author=user)
+        if action == 'approve':
+            comments = comments.filter(approved=False)
+        elif action == 'disapprove':
+            comments = comments.filter(approved=True)
+        with transaction.atomic(using=using):
+            posts_id = set(comments.values_list('post', flat=True))
+            if action == 'delete':
+                moderated, rows = comments.delete()
+            else:
+                moderated = comments.update(approved=(action == 'approve'))
+            if moderated:
+                posts = self.model._meta.get_field('post').related_model.objects
+                posts.db_manager(using).recount_comments(posts_id)
+        if moderated:
+            cache_bust_many([('comments', pk) for pk in posts_id])
+        return moderated
+
 
 class PostManager(models.Manager):
     """
     Post model manager.
     """
 
+    @instrumented
     def get_posts_timeline(self, user, timeline):
         """
         Get the timeline of posts in reverse order
         of creation.
         """
-        key = make_key('posts_timeline', user.pk)
-        posts_timeline = cache.get(key)
-        if posts_timeline is None:
-            posts_timeline = self.filter(pk__in=timeline).order_by('-created')
-            cache.set(key, posts_timeline)
+        queryset = self.filter(pk__in=timeline).order_by('-created')
+        ids, stamp = _cached_ids('posts_timeline', user.pk, queryset, 'created')
+        posts_timeline = _hydrate(self.select_related('author'), ids)
         return posts_timeline
 
+    @instrumented
+    def get_posts_version(self, timeline):
+        """
+        Return the creation date of the newest post of the
+        timeline, the last time any of them was edited, if
+        ever, and the sum of their versions, changing with
+        any content change.
+        """
+        version = self.filter(pk__in=timeline).aggregate(
+            latest=Max('created'), updated=Max('last_updated'), version=Sum('version'))
+        return version['latest'], version['updated'], version['version'] or 0
+
+    @instrumented
+    def get_posts_page(self, timeline, cursor=None, limit=20):
+        """
+        Get one page of the timeline of posts in reverse
+        order of creation, starting after the (created, pk)
+        cursor of the previous page if any.
+        """
+        posts = self.filter(pk__in=timeline)
+        if cursor is not None:
+            created, pk = cursor
+            posts = posts.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+        posts = posts.order_by('-created', '-pk')[:limit]
+        return posts
+
+    @instrumented
+    async def aget_posts_page(self, timeline, cursor=None, limit=20):
+        """
+        Get one page of the timeline of posts without
+        blocking the event loop. Return a list of posts.
+        """
+        posts = await run_sync(lambda: list(self.get_posts_page(timeline, cursor, limit)))
+        return posts
+
+    @instrumented
+    def update_comments_count(self, post, approved=0, disapproved=0):
+        """
+        Atomically update the comment counters of a post
+        by the given approved and disapproved deltas.
+        """
+        updated = self.filter(pk=post.pk).update(
+            comments_count=F('comments_count') + approved + disapproved,
+            approved_comments_count=F('approved_comments_count') + approved,
+            disapproved_comments_count=F('disapproved_comments_count') + disapproved,
+        )
+        return updated
+
+    @instrumented
+    def recount_comments(self, posts_id):
+        """
+        Recompute the comment counters of several posts
+        from the comment table with one update query.
+        """
+        comments = self.model._meta.get_field('comment').related_model.objects
+        comments = comments.filter(post=OuterRef('pk')).order_by().values('post')
+
+        def counter(**filters):
+            count = comments.filter(**filters).annotate(count=Count('pk')).values('count')
+            return Coalesce(Subquery(count, output_field=models.IntegerField()), 0)
+
+        updated = self.filter(pk__in=list(posts_id)).update(
+            comments_count=counter(),
+            approved_comments_count=counter(approved=True),
+            disapproved_comments_count=counter(approved=False),
+        )
+        return updated
+
+    @instrumented
+    def _bulk_create_with_pks(self, posts):
+        """
+        Insert several posts with one query and set their pks.
+        Must run inside a transaction.
+        """
+        if connections[self.db].features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(posts)
+        # Without returned ids, the rows inserted by this transaction
+        # are the ones above the previous highest pk.
+        last_pk = self.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+        self.bulk_create(posts)
+        pks = list(self.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+        if len(pks) != len(posts):
+            raise IntegrityError('Concurrent posts inserted during bulk import.')
+        for post, pk in zip(posts, pks):
+            post.pk = pk
+        return posts
+
+    @instrumented
+    def bulk_import(self, records, chunk_size=1000):
+        """
+        Import posts from an iterable of dicts of post fields
+        (author_id, title, body, created, ...), adding them to
+        their authors' timelines.
+        Each chunk is written with two bulk inserts in one
+        transaction, and the caches of every affected user are
+        busted once at the end, even if a later chunk fails.
+        Return the number of imported posts.
+        """
+        using = self._db or router.db_for_write(self.model)
+        posts_manager = self.db_manager(using)
+        timelines = self.model._meta.get_field('timeline').related_model.objects.db_manager(using)
+        records = iter(records)
+        authors = set()
+        imported = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                posts = [self.model(**record) for record in chunk]
+                with transaction.atomic(using=using):
+                    posts = posts_manager._bulk_create_with_pks(posts)
+                    timelines.bulk_add_to_timeline(posts)
+                authors.update(post.author_id for post in posts)
+                imported += len(posts)
+        finally:
+            # Chunks committed before a failure are busted too.
+            if authors:
+                timelines.bust_timelines(authors)
+        return imported
+
+    @instrumented
     def posts(self, user):
         """
         Return all user's posts.
         """
-        key = make_key('posts', user.pk)
-        posts = cache.get(key)
-        if posts is None:
-            posts = self.filter(author=user)
-            cache.set(key, posts)
+        ids, stamp = _cached_ids('posts', user.pk, self.filter(author=user), 'created')
+        posts = _hydrate(self.all(), ids)
         return posts
 
+    @instrumented
     def post_count(self, user):
         """
         Return a count of one user's posts.
         """
-        count = self.posts(user).count()
+        ids, stamp = _cached_ids('posts', user.pk, self.filter(author=user), 'created')
+        count = len(ids)
         return count
 
 
@@ -126,61 +395,475 @@ class TimelineManager(models.Manager):
     Timeline model manager.
     """
 
+    @instrumented
     def add_to_timeline(self, instance, user):
         """
-        Add instance to user's timeline when saving.
+        Add instance to user's timeline when saving
+        and bust the timeline caches of his followers.
         """
         ctype = ContentType.objects.get_for_model(instance)
-        timeline, created = self.get_or_create(content_type=ctype, object_id=instance.pk, user=user, date=instance.created)
-        if created:
-            cache_bust([('posts_timeline', user.pk)])
-            return timeline
-        return False
+        try:
+            # Duplicates are rejected by the unique constraint.
+            with transaction.atomic(using=write_alias()):
+                timeline = self.create(content_type=ctype, object_id=instance.pk, user=user, date=instance.created)
+        except IntegrityError:
+            return False
+        cache_bust([('posts_timeline', user.pk)])
+        followers = None
+        if getattr(settings, 'TIMELINE_FANOUT', False):
+            followers = self._push_to_feeds(timeline)
+        self.bust_followers(user=user, followers=followers)
+        return timeline
+
+    @instrumented
+    def bulk_add_to_timeline(self, instances):
+        """
+        Add several instances to their authors' timelines
+        with one insert. Caches are left to bust_timelines.
+        """
+        timelines = [
+            self.model(content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk,
+                       user_id=instance.author_id, date=instance.created)
+            for instance in instances
+        ]
+        return self.bulk_create(timelines)
 
+    @instrumented
     def remove_from_timeline(self, instance, user):
         """
         Remove instance from user's timeline when deleting.
+        Return the removed timeline entry.
         """
         ctype = ContentType.objects.get_for_model(instance)
         try:
             timeline = self.get(content_type=ctype, object_id=instance.pk, user=user)
             timeline.delete()
-            return True
+            return timeline
         except self.model.DoesNotExist:
             raise ObjectDoesNotExist('Failure trying to delete {instance}'.format(instance=instance.title))
 
-    def _is_installed_app(self, app):
+    @instrumented
+    def _registry(self):
         """
-        Check if a concrete web application is
-        installed in settings.INSTALLED_APPS.
+        Return the timeline app registry built at startup.
         """
-        installed_apps = getattr(settings, 'INSTALLED_APPS', None)
-        if installed_apps is None:
-            raise AttributeError('Error getting INSTALLED_APPS attribute.')
-        if app in installed_apps:
-            return True
-        else:
-            installed_apps_short = [apps_long.split('.')[-1] for apps_long in installed_apps]
-            if app in installed_apps_short:
-                return True
-        return False
+        return apps.get_app_config('timeline')
 
+    @instrumented
+    def _content_type(self, model):
+        """
+        Resolve a model name to its content type.
+        """
+        ctype = self._registry().content_types().get(model)
+        if ctype is None:
+            ctype = ContentType.objects.get(model=model)
+        return ctype
+
+    def _follow(self):
+        """
+        Return the Follow model of the follow app.
+        Only call it when the follow app is installed.
+        """
+        return apps.get_model('follow', 'Follow')
+
+    @instrumented
+    def _followees(self, user):
+        """
+        Return user's followees id's.
+        """
+        if self._registry().follow_installed:
+            followees = self._follow().objects.followees(user=user)
+            return [followee.pk for followee in followees]
+        return []
+
+    @instrumented
+    def _followers(self, user):
+        """
+        Return user's followers id's.
+        """
+        if self._registry().follow_installed:
+            followers = self._follow().objects.followers(user=user)
+            return [follower.pk for follower in followers]
+        return []
+
+    @instrumented
+    def _followers_count(self, user):
+        """
+        Return the number of user's followers.
+        """
+        if self._registry().follow_installed:
+            return self._follow().objects.filter(followee=user).count()
+        return 0
+
+    @instrumented
+    def _followees_many(self, users):
+        """
+        Return a dict mapping several users id's
+        to their followees id's, with one query.
+        """
+        followees = {user.pk: [] for user in users}
+        if self._registry().follow_installed:
+            edges = self._follow().objects.filter(follower__pk__in=list(followees)).values_list('follower', 'followee')
+            for follower, followee in edges.iterator():
+                followees[follower].append(followee)
+        return followees
+
+    @instrumented
+    def _followers_many(self, users_id):
+        """
+        Return the followers id's of several users, with one
+        query per settings.TIMELINE_BULK_CHUNK_SIZE users.
+        """
+        followers = set()
+        if self._registry().follow_installed:
+            chunk_size = getattr(settings, 'TIMELINE_BULK_CHUNK_SIZE', 200)
+            users_id = list(users_id)
+            for start in range(0, len(users_id), chunk_size):
+                edges = self._follow().objects.filter(followee__pk__in=users_id[start:start + chunk_size])
+                followers.update(edges.values_list('follower', flat=True).iterator())
+        return followers
+
+    @instrumented
+    def bust_timelines(self, users_id):
+        """
+        Bust once the timeline caches of several authors and
+        their followers, dropping their materialized feeds
+        so they are rebuilt with the new entries.
+        """
+        authors = set(users_id)
+        followers = self._followers_many(authors) - authors
+        cache_types = [(key_type, pk) for pk in authors for key_type in ('posts_timeline', 'timeline_bucket')]
+        cache_types.extend(('followees_history', pk) for pk in followers)
+        cache_bust_many(cache_types)
+        if getattr(settings, 'TIMELINE_FANOUT', False):
+            feed_cache().delete_many([make_key('feed', pk) for pk in authors | followers])
+
+    @instrumented
+    def bust_follower(self, user_id):
+        """
+        Bust the timeline caches of a user whose followees
+        changed, dropping the materialized feed so it is
+        rebuilt from the new followees.
+        """
+        cache_bust([('followees_history', user_id)])
+        if getattr(settings, 'TIMELINE_FANOUT', False):
+            feed_cache().delete(make_key('feed', user_id))
+
+    @instrumented
+    def bust_removed(self, timeline, user):
+        """
+        Bust the timeline caches of user's followers, past
+        entries included, after an entry of his timeline
+        was removed, and remove it from the materialized
+        feeds with fan-out on write.
+        """
+        followers = None
+        if getattr(settings, 'TIMELINE_FANOUT', False):
+            followers = self._remove_from_feeds(timeline, user)
+        return self.bust_followers(user=user, followers=followers, key_type='followees_history')
+
+    @instrumented
+    def bust_followers(self, user, followers=None, key_type='followees'):
+        """
+        Bust the timeline caches of user's followers after he
+        posts or deletes content, given their id's if already
+        fetched. Their own posts are left cached. key_type
+        'followees_history' busts the closed day buckets too,
+        after past entries changed, and 'timeline_version'
+        only the validators, after posts were edited.
+        Busts for users with more followers than
+        settings.TIMELINE_INVALIDATION_SYNC_LIMIT run in the
+        background, where the followers are fetched too.
+        """
+        sync_limit = getattr(settings, 'TIMELINE_INVALIDATION_SYNC_LIMIT', 1000)
+        count = len(followers) if followers is not None else self._followers_count(user)
+        if count > sync_limit:
+            if followers is not None:
+                return cache_bust_async([(key_type, pk) for pk in followers])
+
+            def cache_types():
+                try:
+                    return [(key_type, pk) for pk in self._followers(user)]
+                finally:
+                    # The bust thread holds its own connections.
+                    connections.close_all()
+
+            return cache_bust_async(cache_types)
+        if followers is None:
+            followers = self._followers(user)
+        cache_bust_many([(key_type, pk) for pk in followers])
+        return True
+
+    @instrumented
     def _get_query(self, model, user, last_days):
         """
         Construct the query.
         """
-        ctype = ContentType.objects.get(model=model)
+        ctype = self._content_type(model)
         authors_list = [user.pk]
-        if self._is_installed_app('follow'):
-            followees = Follow.objects.followees(user=user)
-            followees_id = [followee.pk for followee in followees]
-            authors_list.extend(followees_id)
+        authors_list.extend(self._followees(user))
+        return self._build_query(ctype, authors_list, last_days)
+
+    def _build_query(self, ctype, authors_list, last_days):
+        """
+        Construct the query from the content type
+        and the authors of the timeline.
+        """
         query = Q(content_type=ctype) & Q(user__pk__in=authors_list)
         if last_days is not None:
             time = timezone.now() - datetime.timedelta(days=last_days)
             query &= Q(date__gt=time)
         return query
 
+    @instrumented
+    def _push_to_feeds(self, timeline):
+        """
+        Fan out a new timeline entry to the materialized
+        feeds of the author and his followers.
+        Authors with more followers than allowed are read
+        on demand instead (pull on read). Feeds store their
+        pull authors, so the first time an author is pulled
+        every feed is rebuilt without his entries.
+        Return the followers id's if fetched.
+        """
+        user = timeline.user
+        followers = self._feed_followers(user)
+        if followers is None:
+            if feed_cache().add(make_key('pull_author', user.pk), True, cache_timeout('pull_author')):
+                cache_bust([('pull_authors', 0)])
+        length = getattr(settings, 'TIMELINE_FANOUT_LENGTH', 800)
+        entry = (timeline.date, timeline.object_id, timeline.content_type_id)
+
+        def push(entries):
+            bisect.insort(entries, entry)
+            del entries[:-length]
+            return True
+
+        self._update_feeds([user.pk] + (followers or []), push)
+        return followers
+
+    @instrumented
+    def _remove_from_feeds(self, timeline, user):
+        """
+        Remove a deleted entry of user's timeline from the
+        materialized feeds of user and his followers. Feeds
+        do not hold the entries of pulled authors but their
+        own.
+        Return the followers id's if fetched.
+        """
+        followers = self._feed_followers(user)
+        entry = (timeline.date, timeline.object_id, timeline.content_type_id)
+
+        def remove(entries):
+            index = bisect.bisect_left(entries, entry)
+            if index < len(entries) and entries[index] == entry:
+                del entries[index]
+                return True
+            return False
+
+        self._update_feeds([user.pk] + (followers or []), remove)
+        return followers
+
+    def _feed_followers(self, user):
+        """
+        Return the followers id's of an author fanned out on
+        write, or None if he has more followers than
+        settings.TIMELINE_FANOUT_MAX_FOLLOWERS.
+        """
+        max_followers = getattr(settings, 'TIMELINE_FANOUT_MAX_FOLLOWERS', 5000)
+        if self._followers_count(user) > max_followers:
+            return None
+        return self._followers(user)
+
+    def _update_feeds(self, users_id, update):
+        """
+        Apply an update to the entries of the materialized
+        feeds of several users, in batches of
+        settings.TIMELINE_FANOUT_BATCH_SIZE feeds. Only
+        already materialized feeds are updated, and only
+        written back if the update returns True.
+        """
+        batch_size = getattr(settings, 'TIMELINE_FANOUT_BATCH_SIZE', 500)
+        fcache = feed_cache()
+        for start in range(0, len(users_id), batch_size):
+            keys = [make_key('feed', pk) for pk in users_id[start:start + batch_size]]
+            feeds = fcache.get_many(keys)
+            # Feed entries are kept in ascending order.
+            changed = {key: feed for key, feed in feeds.items() if update(feed[0])}
+            if changed:
+                fcache.set_many(changed, cache_timeout('feed'))
+
+    @instrumented
+    def _build_feed(self, user, authors_list):
+        """
+        Materialize user's feed from the timeline table.
+        """
+        length = getattr(settings, 'TIMELINE_FANOUT_LENGTH', 800)
+        entries = self.filter(user__pk__in=authors_list).order_by('-date', '-object_id')
+        entries = entries.values_list('date', 'object_id', 'content_type_id')[:length]
+        return sorted(entries)
+
+    @instrumented
+    def _pull_authors(self, followees):
+        """
+        Return the followees id's read on demand
+        instead of fanned out on write.
+        """
+        pull_keys = {make_key('pull_author', pk): pk for pk in followees}
+        return [pull_keys[key] for key in cache_get_many('pull_author', pull_keys.keys(), feed_cache())]
+
+    @instrumented
+    def _read_feed(self, model, user, last_days):
+        """
+        Read user's timeline from the materialized feed
+        merged with the entries of followees that are
+        not fanned out on write.
+        Feeds store the (entries, pull authors, generation)
+        of user, without the entries of pulled authors, so
+        followees are only fetched to build a feed, again
+        when new authors were pulled since, as told by the
+        pull authors generation.
+        Return (date, object_id) entries.
+        """
+        ctype = self._content_type(model)
+        fcache = feed_cache()
+        key = make_key('feed', user.pk)
+        generation = make_key('pull_authors', 0)
+        feed = cache_get('feed', key, fcache)
+        if feed is None or feed[2] != generation:
+            followees = self._followees(user)
+            pull_authors = self._pull_authors(followees)
+            pushed = set(followees).difference(pull_authors)
+            feed = (self._build_feed(user, [user.pk] + list(pushed)), pull_authors, generation)
+            fcache.set(key, feed, cache_timeout('feed'))
+        entries, pull_authors, generation = feed
+        entries = set(entries)
+        if pull_authors:
+            length = getattr(settings, 'TIMELINE_FANOUT_LENGTH', 800)
+            pulled = self.filter(content_type=ctype, user__pk__in=pull_authors).order_by('-date', '-object_id')
+            entries.update(pulled.values_list('date', 'object_id', 'content_type_id')[:length])
+        time = None
+        if last_days is not None:
+            time = timezone.now() - datetime.timedelta(days=last_days)
+        timeline = [(date, object_id) for date, object_id, ctype_id in sorted(entries, reverse=True)
+                    if ctype_id == ctype.pk and (time is None or date > time)]
+        return timeline
+
+    @instrumented
+    def get_timeline_page(self, model, user, cursor=None, limit=20):
+        """
+        Get one page of user's timeline in reverse order of date,
+        starting after the (date, object_id) cursor of the previous
+        page if any. Pages are sliced from the cached timeline, or
+        the materialized feed with fan-out on write, and queried
+        only when the cursor is not found in them, a feed ends
+        before the page does or the last entry of the page is gone.
+        Return instances id's and the cursor of the next page,
+        set whenever the page is full.
+        """
+        fanout = getattr(settings, 'TIMELINE_FANOUT', False)
+        if fanout:
+            entries = self._read_feed(model, user, None)
+            timeline = [object_id for date, object_id in entries]
+        else:
+            timeline = self.get_timeline(model, user)
+        start = 0
+        if cursor is not None:
+            date, object_id = cursor
+            try:
+                start = timeline.index(object_id) + 1
+            except ValueError:
+                start = None
+        if start is not None:
+            page = timeline[start:start + limit]
+            if len(page) < limit and not fanout:
+                # The cached timeline is complete, feeds are truncated.
+                return page, None
+            if len(page) == limit and fanout:
+                return page, entries[start + limit - 1]
+            if len(page) == limit:
+                # The cached timeline only holds id's.
+                ctype = self._content_type(model)
+                date = self.filter(content_type=ctype, object_id=page[-1]).values_list('date', flat=True).first()
+                if date is not None:
+                    return page, (date, page[-1])
+        query = self._get_query(model, user, None)
+        return self._timeline_page(query, cursor, limit)
+
+    def _timeline_page(self, query, cursor, limit):
+        """
+        Return one page of the instances id's matching a
+        timeline query, starting after the cursor if any,
+        and the cursor of the next page if the page is full.
+        """
+        if cursor is not None:
+            date, object_id = cursor
+            query &= Q(date__lt=date) | Q(date=date, object_id__lt=object_id)
+        timeline = self.filter(query).order_by('-date', '-object_id')
+        timeline = list(timeline.values_list('date', 'object_id')[:limit])
+        next_cursor = timeline[-1] if len(timeline) == limit else None
+        return [object_id for date, object_id in timeline], next_cursor
+
+    def _bucket(self, date):
+        """
+        Return the day bucket, in UTC, of a timeline date.
+        """
+        if timezone.is_aware(date):
+            date = timezone.localtime(date, timezone.utc)
+        return date.date()
+
+    def _bucket_start(self, day):
+        """
+        Return the first instant of a day bucket.
+        """
+        start = datetime.datetime.combine(day, datetime.time.min)
+        if settings.USE_TZ:
+            start = timezone.make_aware(start, timezone.utc)
+        return start
+
+    @instrumented
+    def _get_buckets_timeline(self, model, user, last_days):
+        """
+        Construct user's timeline for the last days from
+        per day buckets of (date, object_id) entries.
+        Closed days are cached until past entries change,
+        so only the current day and the missing days are
+        queried.
+        """
+        time = timezone.now() - datetime.timedelta(days=last_days)
+        today = self._bucket(timezone.now())
+        first = self._bucket(time)
+        days = [first + datetime.timedelta(days=n) for n in range((today - first).days + 1)]
+        # Closed buckets share the generation of the user's bucket key,
+        # busted only when past entries change. The current bucket
+        # follows the generation of the timeline, busted on every post.
+        closed_prefix = make_key('timeline_bucket', user.pk)
+        prefixes = {day: closed_prefix for day in days[:-1]}
+        prefixes[today] = make_key('timeline', user.pk)
+        keys = {day: '{prefix}:{day}'.format(prefix=prefixes[day], day=day.isoformat()) for day in days}
+        cached = cache_get_many('timeline_bucket', keys.values())
+        buckets = {day: cache_value(cached[key]) for day, key in keys.items() if key in cached}
+        missing = [day for day in days if day not in buckets]
+        if missing:
+            computed = {day: [] for day in missing}
+            query = self._get_query(model, user, None)
+            query &= Q(date__gte=self._bucket_start(missing[0]))
+            query &= Q(date__lt=self._bucket_start(missing[-1] + datetime.timedelta(days=1)))
+            with metrics.timer('query.timeline_bucket'):
+                rows = self.filter(query).order_by('-date', '-object_id').values_list('date', 'object_id')
+                for date, object_id in rows:
+                    day = self._bucket(date)
+                    if day in computed:
+                        computed[day].append((date, object_id))
+            closed = {keys[day]: entries for day, entries in computed.items() if day != today}
+            cache_store_many(closed, cache_timeout('timeline_bucket'))
+            if today in computed:
+                cache_store(keys[today], computed[today], cache_timeout('timeline'))
+            buckets.update(computed)
+        timeline = [object_id for day in reversed(days) for date, object_id in buckets[day] if date > time]
+        return timeline
+
+    @instrumented
     def get_timeline(self, model, user, last_days=None):
         """
         Construct the timeline for each user.
@@ -188,10 +871,175 @@ class TimelineManager(models.Manager):
         and his followees and contacts if any.
         Return instances id's.
         """
+        if getattr(settings, 'TIMELINE_FANOUT', False):
+            return [object_id for date, object_id in self._read_feed(model, user, last_days)]
+        if last_days is not None:
+            return self._get_buckets_timeline(model, user, last_days)
         key = make_key('timeline', user.pk)
-        timeline = cache.get(key)
-        if timeline is None:
-            query = self._get_query(model, user, last_days)
-            timeline = self.filter(query).values_list('object_id', flat=True)
-            cache.set(key, timeline)
+
+        def compute():
+            query = self._get_query(model, user, None)
+            with metrics.timer('query.timeline'):
+                rows = list(self.filter(query).order_by('-date', '-object_id').values_list('object_id', 'date'))
+            return pack([object_id for object_id, date in rows], rows[0][1] if rows else None)
+
+        timeline, stamp = cached_read('timeline', key, compute, cache_timeout('timeline'))
+        return timeline
+
+    @instrumented
+    def get_feed(self, user, cursor=None, limit=20):
+        """
+        Get one page of user's timeline merging every timeline
+        model, in reverse order of date, starting after the
+        (date, timeline pk) cursor of the previous page if any.
+        Instances are fetched with one query per content type.
+        Return the instances and the cursor of the next page.
+        """
+        ctypes = self._registry().content_types().values()
+        authors_list = [user.pk] + self._followees(user)
+        query = Q(content_type__in=list(ctypes)) & Q(user__pk__in=authors_list)
+        if cursor is not None:
+            date, pk = cursor
+            query &= Q(date__lt=date) | Q(date=date, pk__lt=pk)
+        entries = self.filter(query).order_by('-date', '-pk')
+        entries = list(entries.values_list('pk', 'date', 'content_type_id', 'object_id')[:limit])
+        objects_id = defaultdict(list)
+        for pk, date, ctype_id, object_id in entries:
+            objects_id[ctype_id].append(object_id)
+        instances = {}
+        for ctype_id, ids in objects_id.items():
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            with metrics.timer('hydrate.{model}'.format(model=model._meta.model_name)):
+                for object_id, instance in model._default_manager.in_bulk(ids).items():
+                    instances[(ctype_id, object_id)] = instance
+        feed = [instances[(ctype_id, object_id)] for pk, date, ctype_id, object_id in entries
+                if (ctype_id, object_id) in instances]
+        next_cursor = None
+        if len(entries) == limit:
+            next_cursor = (entries[-1][1], entries[-1][0])
+        return feed, next_cursor
+
+    @instrumented
+    def get_timeline_since(self, user, model, since_date, since_pk=0, limit=20):
+        """
+        Get the entries of user's timeline newer than the
+        (since_date, since_pk) high water mark of a client,
+        oldest first, so the last one is the next mark.
+        Return instances id's.
+        """
+        query = self._get_query(model, user, None)
+        query &= Q(date__gt=since_date) | Q(date=since_date, object_id__gt=since_pk)
+        timeline = self.filter(query).order_by('date', 'object_id')
+        timeline = timeline.values_list('object_id', flat=True)[:limit]
+        return list(timeline)
+
+    @instrumented
+    async def aget_timeline(self, model, user, last_days=None):
+        """
+        Get user's timeline without blocking the event loop.
+        """
+        timeline = await run_sync(self.get_timeline, model, user, last_days)
         return timeline
+
+    @instrumented
+    async def aget_timeline_page(self, model, user, cursor=None, limit=20):
+        """
+        Get one page of user's timeline and the cursor of
+        the next page without blocking the event loop.
+        """
+        timeline, next_cursor = await run_sync(self.get_timeline_page, model, user, cursor, limit)
+        return timeline, next_cursor
+
+    @instrumented
+    async def aget_posts_timeline_page(self, user, cursor=None, limit=20):
+        """
+        Get one page of user's timeline of posts with their
+        comments without blocking the event loop, fetching
+        the page and the timeline version concurrently.
+        Return the posts, a dict mapping their id's to their
+        comments, the timeline version and the next cursor.
+        """
+        Post, Comment = apps.get_model('timeline', 'Post'), apps.get_model('timeline', 'Comment')
+        (timeline, next_cursor), version = await asyncio.gather(
+            self.aget_timeline_page('post', user, cursor, limit),
+            run_sync(self.get_timeline_version, 'post', user),
+        )
+        posts = await Post.objects.aget_posts_page(timeline, cursor, limit)
+        comments = await Comment.objects.acomments_for_posts(posts)
+        return posts, comments, version, next_cursor
+
+    @instrumented
+    def get_timeline_version(self, model, user):
+        """
+        Return the date of the newest entry in user's
+        timeline, the number of entries and the version of
+        their instances from the model manager's
+        get_posts_version, cached until any of them changes.
+        """
+        def compute():
+            timeline = self.get_timeline(model=model, user=user)
+            manager = self._content_type(model).model_class()._default_manager
+            latest, updated, version = manager.get_posts_version(timeline=timeline)
+            return latest, len(timeline), updated, version
+
+        key = make_key('timeline_version', user.pk)
+        return cached_read('timeline_version', key, compute, cache_timeout('timeline_version'))
+
+    @instrumented
+    def get_timelines(self, users, model, last_days=None):
+        """
+        Construct the timelines of several users at once, in
+        chunks of settings.TIMELINE_BULK_CHUNK_SIZE users.
+        Return a dict mapping each user id to instances id's.
+        """
+        chunk_size = getattr(settings, 'TIMELINE_BULK_CHUNK_SIZE', 200)
+        users = iter(users)
+        timelines = {}
+        while True:
+            chunk = list(itertools.islice(users, chunk_size))
+            if not chunk:
+                break
+            timelines.update(self._get_timelines_chunk(chunk, model, last_days))
+        return timelines
+
+    def _get_timelines_chunk(self, users, model, last_days):
+        """
+        Construct the timelines of a chunk of users.
+        Followees of the users are resolved with one query and
+        the union of their timeline entries is fetched once, then
+        split per user in memory and cached with set_many.
+        """
+        keys = make_key_many([('timeline', user.pk) for user in users])
+        # Windowed timelines are not cached under the all time key.
+        cached = cache_get_many('timeline', keys.values()) if last_days is None else {}
+        timelines = {}
+        missing = []
+        for user in users:
+            key = keys[('timeline', user.pk)]
+            if key in cached:
+                timelines[user.pk], stamp = cache_value(cached[key])
+            else:
+                missing.append(user)
+        if not missing:
+            return timelines
+        ctype = self._content_type(model)
+        followees = self._followees_many(missing)
+        authors = {user.pk: set([user.pk] + followees[user.pk]) for user in missing}
+        query = Q(content_type=ctype) & Q(user__pk__in=set().union(*authors.values()))
+        if last_days is not None:
+            time = timezone.now() - datetime.timedelta(days=last_days)
+            query &= Q(date__gt=time)
+        entries = defaultdict(list)
+        with metrics.timer('query.timelines'):
+            rows = self.filter(query).order_by('-date', '-object_id').values_list('user', 'date', 'object_id')
+            for author, date, object_id in rows.iterator():
+                entries[author].append((date, object_id))
+        payloads = {}
+        for user in missing:
+            timeline = list(heapq.merge(*[entries[author] for author in authors[user.pk]], reverse=True))
+            payload = pack([object_id for date, object_id in timeline], timeline[0][0] if timeline else None)
+            payloads[keys[('timeline', user.pk)]] = payload
+            timelines[user.pk] = payload[0]
+        if last_days is None:
+            cache_store_many(payloads, cache_timeout('timeline'))
+        return timelines
@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+
+from .caches import cache_bust
+
+# Create your media processing here.
+
+logger = logging.getLogger('timeline.media')
+
+IMAGE_VARIANTS = {
+    # variant name: (max width, max height)
+    'thumbnail': (200, 200),
+    'medium': (800, 800),
+}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_deletion_queue = queue.Queue()
+_deletion_thread = None
+_deletion_lock = threading.Lock()
+
+
+def image_variants():
+    """
+    Return the sizes of the image variants,
+    overridden by settings.TIMELINE_IMAGE_VARIANTS.
+    """
+    variants = dict(IMAGE_VARIANTS)
+    variants.update(getattr(settings, 'TIMELINE_IMAGE_VARIANTS', {}))
+    return variants
+
+
+def content_hash(path):
+    """
+    Return the sha1 hex digest of a file content.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def render_variants(source, media_root, variants):
+    """
+    Generate the resized variants of an image.
+    Variants are stored once per image content under
+    MEDIA_ROOT/variants/<hash>/ and rendered only if missing.
+    Run in a worker process, so it does not touch Django.
+    Return a dict mapping variant names to relative paths.
+    """
+    from PIL import Image
+
+    digest = content_hash(source)
+    directory = os.path.join('variants', digest[:2], digest[2:4])
+    os.makedirs(os.path.join(media_root, directory), exist_ok=True)
+    image = None
+    paths = {}
+    for name, size in variants.items():
+        path = os.path.join(directory, '{digest}-{name}.jpg'.format(digest=digest, name=name))
+        full_path = os.path.join(media_root, path)
+        if not os.path.exists(full_path):
+            if image is None:
+                image = Image.open(source)
+                image = image.convert('RGB')
+            variant = image.copy()
+            variant.thumbnail(size, Image.LANCZOS)
+            temp_path = '{path}.{pid}.tmp'.format(path=full_path, pid=os.getpid())
+            variant.save(temp_path, 'JPEG', quality=85, optimize=True)
+            os.replace(temp_path, full_path)
+        paths[name] = path
+    return paths
+
+
+def _get_executor():
+    """
+    Return the process pool rendering the image variants.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'TIMELINE_IMAGE_WORKERS', 2)
+            _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def _record_variants(post_pk, future):
+    """
+    Store the rendered variants on the post, changing
+    its version but not its edition date.
+    """
+    from .models import Post, Timeline
+
+    try:
+        paths = future.result()
+    except Exception:
+        logger.exception('Failure rendering the image variants of post %s.', post_pk)
+        return
+    try:
+        Post.objects.filter(pk=post_pk).update(
+            image_thumbnail=paths.get('thumbnail', ''),
+            image_medium=paths.get('medium', ''),
+            version=F('version') + 1,
+        )
+        cache_bust([('post_fragment', post_pk)])
+        post = Post.objects.select_related('author').filter(pk=post_pk).first()
+        if post is not None:
+            cache_bust([('timeline_version', post.author_id)])
+            Timeline.objects.bust_followers(user=post.author, key_type='timeline_version')
+    finally:
+        # Callbacks run in a pool thread holding its own connections.
+        connections.close_all()
+
+
+def process_image(post):
+    """
+    Queue the rendering of the post image variants
+    and return without waiting for it.
+    """
+    if not post.has_media():
+        return None
+    media_root = getattr(settings, 'MEDIA_ROOT', None)
+    future = _get_executor().submit(render_variants, post.image.path, media_root, image_variants())
+    future.add_done_callback(lambda done: _record_variants(post.pk, done))
+    return future
+
+
+def remove_media(paths, media_root):
+    """
+    Remove media files and the directories they leave
+    empty under MEDIA_ROOT. Failures are logged and the
+    files left for the timeline_collect_media command.
+    Return the number of files removed.
+    """
+    media_root = os.path.abspath(media_root)
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('Failure trying to remove %s from filesystem.', path)
+            continue
+        directory = os.path.dirname(os.path.abspath(path))
+        while directory.startswith(media_root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+    return removed
+
+
+def _deletion_worker():
+    """
+    Remove the queued media files in batches.
+    """
+    batch_size = getattr(settings, 'TIMELINE_MEDIA_DELETE_BATCH_SIZE', 100)
+    while True:
+        paths = [_deletion_queue.get()]
+        while len(paths) < batch_size:
+            try:
+                paths.append(_deletion_queue.get_nowait())
+            except queue.Empty:
+                break
+        remove_media(paths, settings.MEDIA_ROOT)
+
+
+def delete_media(paths):
+    """
+    Queue media files for removal by a background thread
+    and return without waiting for it.
+    """
+    global _deletion_thread
+    with _deletion_lock:
+        if _deletion_thread is None:
+            _deletion_thread = threading.Thread(target=_deletion_worker, name='timeline-media-deletion')
+            _deletion_thread.daemon = True
+            _deletion_thread.start()
+    for path in paths:
+        _deletion_queue.put(path)
@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Create your metrics here.
+
+logger = logging.getLogger('timeline.metrics')
+
+
+class RegistrySink(object):
+    """
+    In process registry of counters and timers,
+    readable from the metrics debug view.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timers = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def snapshot(self):
+        """
+        Return the current counters and timers in milliseconds.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timers = {
+                name: {
+                    'count': count,
+                    'total_ms': total * 1000,
+                    'mean_ms': total * 1000 / count,
+                    'max_ms': maximum * 1000,
+                }
+                for name, (count, total, maximum) in self._timers.items()
+            }
+        return {'counters': counters, 'timers': timers}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+class LoggingSink(object):
+    """
+    Write every metric to the timeline.metrics logger.
+    """
+
+    def incr(self, name, value=1):
+        logger.debug('%s +%s', name, value)
+
+    def timing(self, name, seconds):
+        logger.debug('%s %.3fms', name, seconds * 1000)
+
+
+class StatsdSink(object):
+    """
+    Send every metric to a statsd server over UDP, configured with
+    settings.TIMELINE_STATSD_HOST, TIMELINE_STATSD_PORT and
+    TIMELINE_STATSD_PREFIX.
+    """
+
+    def __init__(self):
+        self._address = (
+            getattr(settings, 'TIMELINE_STATSD_HOST', 'localhost'),
+            getattr(settings, 'TIMELINE_STATSD_PORT', 8125),
+        )
+        self._prefix = getattr(settings, 'TIMELINE_STATSD_PREFIX', 'timeline')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self._address)
+        except (OSError, UnicodeError):
+            pass
+
+    def incr(self, name, value=1):
+        self._send('{prefix}.{name}:{value}|c'.format(prefix=self._prefix, name=name, value=value))
+
+    def timing(self, name, seconds):
+        self._send('{prefix}.{name}:{ms:.3f}|ms'.format(prefix=self._prefix, name=name, ms=seconds * 1000))
+
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def sinks():
+    """
+    Return the metric sinks listed in settings.TIMELINE_METRICS_SINKS
+    as dotted paths, by default the in process registry only.
+    """
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                paths = getattr(settings, 'TIMELINE_METRICS_SINKS', ['timeline.metrics.RegistrySink'])
+                _sinks = [import_string(path)() for path in paths]
+    return _sinks
+
+
+def registry():
+    """
+    Return the in process registry sink if configured.
+    """
+    for sink in sinks():
+        if isinstance(sink, RegistrySink):
+            return sink
+    return None
+
+
+def incr(name, value=1):
+    """
+    Increment a counter in every sink.
+    """
+    for sink in sinks():
+        sink.incr(name, value)
+
+
+def timing(name, seconds):
+    """
+    Record a timing in every sink.
+    """
+    for sink in sinks():
+        sink.timing(name, seconds)
+
+
+@contextmanager
+def timer(name):
+    """
+    Time the enclosed block.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start)
+
+
+def instrumented(func):
+    """
+    Count and time every call to a manager method
+    under the name <Manager>.<method>.
+    """
+    name = 'manager.{name}'.format(name=func.__qualname__)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def coroutine_wrapper(*args, **kwargs):
+            incr('{name}.calls'.format(name=name))
+            with timer(name):
+                return await func(*args, **kwargs)
+        return coroutine_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        incr('{name}.calls'.format(name=name))
+        with timer(name):
+            return func(*args, **kwargs)
+    return wrapper
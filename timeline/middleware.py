@@ -0,0 +1,19 @@
+from . import routers
+
+# Create your middleware here.
+
+class ReplicaPinMiddleware(object):
+    """
+    Keep the reads of users who just wrote on the primary
+    database. Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.start_request(request.user)
+        try:
+            return self.get_response(request)
+        finally:
+            routers.end_request()
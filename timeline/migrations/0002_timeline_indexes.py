@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timeline', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='timeline',
+            unique_together=set([('content_type', 'object_id', 'user')]),
+        ),
+        migrations.AddIndex(
+            model_name='timeline',
+            index=models.Index(fields=['content_type', 'user', 'date', 'object_id'], name='tml_ctype_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timeline',
+            index=models.Index(fields=['user', 'date'], name='tml_user_date_idx'),
+        ),
+    ]
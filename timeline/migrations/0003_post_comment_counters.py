@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_comment_counters(apps, schema_editor):
+    """
+    Count the comments of the existing posts, in chunks.
+    """
+    Post = apps.get_model('timeline', 'Post')
+    Comment = apps.get_model('timeline', 'Comment')
+    comments = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post')
+
+    def counter(**filters):
+        count = comments.filter(**filters).annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(count, output_field=models.IntegerField()), 0)
+
+    last_pk = 0
+    while True:
+        posts_id = list(Post.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:1000])
+        if not posts_id:
+            break
+        last_pk = posts_id[-1]
+        Post.objects.filter(pk__in=posts_id).update(
+            comments_count=counter(),
+            approved_comments_count=counter(approved=True),
+            disapproved_comments_count=counter(approved=False),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeline', '0002_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='approved_comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Approved comments count'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Comments count'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='disapproved_comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Disapproved comments count'),
+        ),
+        migrations.RunPython(backfill_comment_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:48
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def relative_image_paths(apps, schema_editor):
+    """
+    Store the absolute post image paths saved by the former
+    user_directory relative to MEDIA_ROOT, as storage names.
+    """
+    media_root = getattr(settings, 'MEDIA_ROOT', None)
+    if not media_root:
+        return
+    media_root = os.path.join(os.path.abspath(media_root), '')
+    Post = apps.get_model('timeline', 'Post')
+    posts = Post.objects.filter(image__startswith=media_root).order_by('pk').values_list('pk', 'image')
+    while True:
+        rows = list(posts[:1000])
+        if not rows:
+            break
+        for pk, image in rows:
+            name = os.path.relpath(image, media_root).replace(os.sep, '/')
+            Post.objects.filter(pk=pk).update(image=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeline', '0003_post_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_medium',
+            field=models.ImageField(blank=True, editable=False, help_text='Image medium size path.', upload_to='', verbose_name='Image medium'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_thumbnail',
+            field=models.ImageField(blank=True, editable=False, help_text='Image thumbnail path.', upload_to='', verbose_name='Image thumbnail'),
+        ),
+        migrations.RunPython(relative_image_paths, migrations.RunPython.noop),
+    ]
@@ -1,34 +1,30 @@
 import os
 
-from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from .caches import cache_bust
 from .managers import CommentManager, PostManager, TimelineManager
+from .media import delete_media
+from .routers import pin_to_primary, write_alias
 
 # Create your models here.
 
 def user_directory(instance, type_content):
+    # Directory is relative to MEDIA_ROOT and created by the storage.
     media_rel_path = '{user}/{type_content}/posts/'.format(user=instance.author, type_content=type_content)
-    directory_abs_path = os.path.join(getattr(settings, 'MEDIA_ROOT', None), media_rel_path)
-    if not os.path.exists(directory_abs_path):
-        try:
-            os.makedirs(directory_abs_path)
-        except OSError:
-            raise('Failure while creating media directory.')
-    return directory_abs_path
+    return media_rel_path
 
 
 def image_full_path(instance, filename):
     # Image will be uploaded to MEDIA_ROOT/<username>/images/posts/
-    directory_abs_path = user_directory(instance, type_content='images')
-    media_path = os.path.join(directory_abs_path, filename)
+    directory_rel_path = user_directory(instance, type_content='images')
+    media_path = os.path.join(directory_rel_path, filename)
     return media_path
 
 
@@ -55,6 +51,11 @@ class Timeline(models.Model):
     class Meta:
         verbose_name = _('Timeline')
         verbose_name_plural = _('Timelines')
+        unique_together = ('content_type', 'object_id', 'user')
+        indexes = [
+            models.Index(fields=['content_type', 'user', 'date', 'object_id'], name='tml_ctype_user_date_idx'),
+            models.Index(fields=['user', 'date'], name='tml_user_date_idx'),
+        ]
 
     def __str__(self):
         """
@@ -93,6 +94,18 @@ class Post(models.Model):
         help_text=_('Image full path.'),
         error_messages={'invalid': _('Please choose a valid format image.')},
     )
+    image_thumbnail = models.ImageField(
+        _('Image thumbnail'),
+        blank=True,
+        editable=False,
+        help_text=_('Image thumbnail path.'),
+    )
+    image_medium = models.ImageField(
+        _('Image medium'),
+        blank=True,
+        editable=False,
+        help_text=_('Image medium size path.'),
+    )
     created = models.DateTimeField(
         _('Created'),
         default=timezone.now,
@@ -104,10 +117,31 @@ class Post(models.Model):
         blank=True,
         editable=True,
     )
+    version = models.PositiveIntegerField(
+        _('Version'),
+        default=0,
+        editable=False,
+        help_text=_('Incremented on every change of the post content.'),
+    )
     timeline = GenericRelation(
         Timeline,
         related_query_name='post',
     )
+    comments_count = models.PositiveIntegerField(
+        _('Comments count'),
+        default=0,
+        editable=False,
+    )
+    approved_comments_count = models.PositiveIntegerField(
+        _('Approved comments count'),
+        default=0,
+        editable=False,
+    )
+    disapproved_comments_count = models.PositiveIntegerField(
+        _('Disapproved comments count'),
+        default=0,
+        editable=False,
+    )
 
     objects = PostManager()
 
@@ -142,28 +176,31 @@ class Post(models.Model):
 
     def _handle_removed_media(self):
         """
-        Remove media from filesystem.
+        Queue media removal from filesystem once the
+        post deletion is committed. Image variants may
+        be shared with other posts and are left to the
+        timeline_collect_media command.
         """
         if self.has_media():
-            try:
-                image = str(self.image)
-                os.remove(image)
-            except OSError:
-                raise('Failure trying to remove image from filesystem.')
+            image = self.image.path
+            transaction.on_commit(lambda: delete_media([image]), using=write_alias())
         return True
 
     def delete(self, user):
         """
         Method to delete content already posted.
-        Handle image removal from filesystem prior to
-        delete its path from database.
+        Image removal from filesystem is deferred until
+        its path is deleted from database.
         """
         if user.is_authenticated() and self.author == user:
-            if self._handle_removed_media():
-                Timeline.objects.remove_from_timeline(instance=self, user=user)
+            with transaction.atomic(using=write_alias()):
+                self._handle_removed_media()
+                timeline = Timeline.objects.remove_from_timeline(instance=self, user=user)
                 super(Post, self).delete()
-                cache_bust([('posts_timeline', user.pk), ('comments', self.pk)])
-                return True
+            cache_bust([('posts_timeline', user.pk), ('timeline_bucket', user.pk), ('comments', self.pk)])
+            Timeline.objects.bust_removed(timeline=timeline, user=user)
+            pin_to_primary(user)
+            return True
         return False
 
 
@@ -219,7 +256,9 @@ class Comment(models.Model):
         """
         if not self.approved:
             self.approved = True
-            self.save()
+            with transaction.atomic(using=write_alias()):
+                if Comment.objects.filter(pk=self.pk, approved=False).update(approved=True):
+                    Post.objects.update_comments_count(self.post, approved=1, disapproved=-1)
             cache_bust([('comments', self.post.pk)])
             return True
 
@@ -229,7 +268,9 @@ class Comment(models.Model):
         """
         if self.approved:
             self.approved = False
-            self.save()
+            with transaction.atomic(using=write_alias()):
+                if Comment.objects.filter(pk=self.pk, approved=True).update(approved=False):
+                    Post.objects.update_comments_count(self.post, approved=-1, disapproved=1)
             cache_bust([('comments', self.post.pk)])
             return True
 
@@ -248,7 +289,13 @@ class Comment(models.Model):
         """
         if user.is_authenticated() and self.author == user:
             post = self.post
-            super(Comment, self).delete()
+            with transaction.atomic(using=write_alias()):
+                # The stored approval decides the counter, not a stale instance.
+                if Comment.objects.filter(pk=self.pk, approved=True).delete()[0]:
+                    Post.objects.update_comments_count(post, approved=-1)
+                elif Comment.objects.filter(pk=self.pk, approved=False).delete()[0]:
+                    Post.objects.update_comments_count(post, disapproved=-1)
             cache_bust([('comments', post.pk)])
+            pin_to_primary(user)
             return post
         return False
@@ -0,0 +1,40 @@
+import base64
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+# Create your pagination helpers here.
+
+def page_size():
+    """
+    Number of items per timeline page.
+    """
+    return getattr(settings, 'TIMELINE_PAGE_SIZE', 20)
+
+
+def encode_cursor(created, pk):
+    """
+    Build an opaque cursor from the (created, pk)
+    pair of the last item in a page.
+    """
+    value = '{created}|{pk}'.format(created=created.isoformat(), pk=pk)
+    cursor = base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+    return cursor.rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (created, pk) pair hidden in an opaque cursor.
+    Raise ValueError if the cursor is malformed.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        value = base64.urlsafe_b64decode((cursor + padding).encode('ascii')).decode('utf-8')
+        created, pk = value.split('|')
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor {cursor}.'.format(cursor=cursor))
+    if created is None:
+        raise ValueError('Invalid cursor {cursor}.'.format(cursor=cursor))
+    return created, pk
@@ -0,0 +1,109 @@
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caches import make_key
+
+# Create your database routers here.
+
+_state = threading.local()
+
+
+def write_alias():
+    """
+    Return the database taking the timeline writes.
+    """
+    return getattr(settings, 'TIMELINE_WRITE_DATABASE', 'default')
+
+
+def read_replicas():
+    """
+    Return the databases serving the timeline reads.
+    """
+    return getattr(settings, 'TIMELINE_READ_REPLICAS', [])
+
+
+def pin_to_primary(user):
+    """
+    Send user's reads to the primary database for
+    settings.TIMELINE_REPLICA_PIN_SECONDS after a write,
+    so he reads his own writes despite replication lag.
+    """
+    seconds = getattr(settings, 'TIMELINE_REPLICA_PIN_SECONDS', 5)
+    cache.set(make_key('replica_pin', user.pk), True, seconds)
+    _state.pinned = True
+
+
+def start_request(user):
+    """
+    Load the pin of the user making the current request
+    and pick the replica serving all its reads.
+    """
+    _state.pinned = user.is_authenticated() and bool(cache.get(make_key('replica_pin', user.pk)))
+    _state.replica = None
+
+
+def end_request():
+    _state.pinned = False
+    _state.replica = None
+
+
+def request_state():
+    """
+    Return the pin and the replica of the current request,
+    to serve its reads from another thread.
+    """
+    return getattr(_state, 'pinned', False), getattr(_state, 'replica', None)
+
+
+def restore_state(state):
+    _state.pinned, _state.replica = state
+
+
+def read_alias():
+    """
+    Return the database for a timeline read: the primary
+    if the current user is pinned, else the replica picked
+    at random for the current request, so all the reads of
+    a page see the same replication lag.
+    """
+    replicas = read_replicas()
+    if not replicas or getattr(_state, 'pinned', False):
+        return write_alias()
+    replica = getattr(_state, 'replica', None)
+    if replica not in replicas:
+        replica = _state.replica = random.choice(replicas)
+    return replica
+
+
+class TimelineRouter(object):
+    """
+    Route the timeline app reads to the replicas listed in
+    settings.TIMELINE_READ_REPLICAS and its writes to the primary.
+    """
+
+    def _is_timeline(self, model):
+        return model._meta.app_label == 'timeline'
+
+    def db_for_read(self, model, **hints):
+        if self._is_timeline(model):
+            return read_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_timeline(model):
+            return write_alias()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set(read_replicas()) | {write_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in read_replicas():
+            return False
+        return None
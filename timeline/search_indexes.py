@@ -1,3 +1,4 @@
+from django.db.models import Q
 from haystack import indexes
 
 from .models import Post
@@ -9,12 +10,27 @@ class PostIndex(indexes.SearchIndex, indexes.Indexable):
     author = indexes.CharField(model_attr='author')
     title = indexes.CharField(model_attr='title')
     body = indexes.CharField(model_attr='body')
-    created = indexes.CharField(model_attr='created')
-    last_updated = indexes.CharField(model_attr='last_updated')
+    created = indexes.DateTimeField(model_attr='created')
+    last_updated = indexes.DateTimeField(model_attr='last_updated', null=True)
 
     def get_model(self):
         return Post
 
+    def get_updated_field(self):
+        "Used by update_index --age to only index recent changes."
+        return 'last_updated'
+
     def index_queryset(self, using=None):
         "Used when the entire index for model is updated."
-        return self.get_model().objects.all()
+        return self.get_model().objects.select_related('author')
+
+    def build_queryset(self, using=None, start_date=None, end_date=None):
+        "Used by incremental updates, falling back to creation date for never edited posts."
+        queryset = self.index_queryset(using=using)
+        if start_date:
+            queryset = queryset.filter(Q(last_updated__gte=start_date) |
+                                       Q(last_updated__isnull=True, created__gte=start_date))
+        if end_date:
+            queryset = queryset.filter(Q(last_updated__lte=end_date) |
+                                       Q(last_updated__isnull=True, created__lte=end_date))
+        return queryset.order_by('pk')
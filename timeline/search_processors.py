@@ -0,0 +1,108 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import signals
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import get_identifier
+
+# Create your search signal processors here.
+
+logger = logging.getLogger('timeline.search')
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Signal processor that coalesces post saves and deletes
+    and applies them to the search index in batches from a
+    background thread.
+    Enable it with:
+    HAYSTACK_SIGNAL_PROCESSOR = 'timeline.search_processors.QueuedSignalProcessor'
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        super(QueuedSignalProcessor, self).__init__(*args, **kwargs)
+
+    def setup(self):
+        from .models import Post
+
+        signals.post_save.connect(self.enqueue_save, sender=Post)
+        signals.post_delete.connect(self.enqueue_delete, sender=Post)
+        atexit.register(self.flush)
+
+    def teardown(self):
+        from .models import Post
+
+        signals.post_save.disconnect(self.enqueue_save, sender=Post)
+        signals.post_delete.disconnect(self.enqueue_delete, sender=Post)
+
+    def _enqueue(self, pk, identifier):
+        """
+        Queue one change, keeping only the last one per post.
+        Deletes carry the post identifier since the row is gone.
+        """
+        batch_size = getattr(settings, 'TIMELINE_SEARCH_BATCH_SIZE', 100)
+        with self._lock:
+            self._pending[pk] = identifier
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='timeline-search-queue')
+                self._worker.daemon = True
+                self._worker.start()
+            if len(self._pending) >= batch_size:
+                self._wakeup.set()
+
+    def enqueue_save(self, sender, instance, **kwargs):
+        self._enqueue(instance.pk, None)
+
+    def enqueue_delete(self, sender, instance, **kwargs):
+        self._enqueue(instance.pk, get_identifier(instance))
+
+    def _run(self):
+        interval = getattr(settings, 'TIMELINE_SEARCH_FLUSH_INTERVAL', 5)
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failure trying to flush the search queue.')
+            finally:
+                connections.close_all()
+
+    def flush(self):
+        """
+        Apply the queued changes with one bulk update
+        and the deletes for every writable backend.
+        On a backend failure the batch is queued again,
+        behind any newer change of the same posts.
+        """
+        from .models import Post
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        updates = [pk for pk, identifier in pending.items() if identifier is None]
+        deletes = [identifier for identifier in pending.values() if identifier is not None]
+        failed = False
+        for using in self.connection_router.for_write():
+            try:
+                backend = self.connections[using].get_backend()
+                index = self.connections[using].get_unified_index().get_index(Post)
+                if updates:
+                    backend.update(index, index.index_queryset(using=using).filter(pk__in=updates))
+                for identifier in deletes:
+                    backend.remove(identifier)
+            except Exception:
+                logger.exception('Failure trying to update the search index %s.', using)
+                failed = True
+        if failed:
+            with self._lock:
+                for pk, identifier in pending.items():
+                    self._pending.setdefault(pk, identifier)
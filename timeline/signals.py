@@ -1 +1,11 @@
+from .models import Timeline
 
+# Create your signals here.
+
+def follow_changed(sender, instance, **kwargs):
+    """
+    Rebuild the timeline of a user who follows or
+    unfollows someone. Connected by the app config
+    only when the follow app is installed.
+    """
+    Timeline.objects.bust_follower(user_id=instance.follower_id)
@@ -1,25 +1,100 @@
 from django import template
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
 
-from .models import Comment
+from ..caches import cache_get_many, cache_store_many, cache_timeout, cache_value, make_key_many
+from ..models import Comment
 
 # Create your template tags here.
 
 register = template.Library()
 
 
-@register.simple_tag
-def post_comments(post):
+def _memo(context, name):
+    """
+    Return a per request memo shared by the tags.
+    """
+    request = context.get('request')
+    if request is None:
+        return {}
+    memo = getattr(request, '_timeline_tags_memo', None)
+    if memo is None:
+        memo = request._timeline_tags_memo = {}
+    return memo.setdefault(name, {})
+
+
+def _page_posts(context, post):
+    """
+    Return the posts rendered in the page, so the
+    tags can load their comments all at once.
+    """
+    posts = list(context.get('posts') or [])
+    if post not in posts:
+        posts.append(post)
+    return posts
+
+
+@register.simple_tag(takes_context=True)
+def post_comments(context, post):
     """
     Simple tag to retrieve all comments.
     """
-    comments = Comment.objects.comments(post=post)
+    memo = _memo(context, 'comments')
+    if post.pk not in memo:
+        memo.update(Comment.objects.comments_for_posts(posts=_page_posts(context, post)))
+    comments = memo[post.pk]
     return comments
 
 
-@register.simple_tag
-def post_comments_count(post):
+@register.simple_tag(takes_context=True)
+def post_comments_count(context, post):
     """
     Simple tag to display the total count of comments for one post.
     """
-    comments_count = Comment.objects.comments_count(post=post)
+    memo = _memo(context, 'comments_count')
+    if post.pk not in memo:
+        memo.update(Comment.objects.counts_for_posts(posts=_page_posts(context, post)))
+    comments_count = memo[post.pk]
     return comments_count
+
+
+def _render_post_cards(context, posts, template_name):
+    """
+    Return a dict with the rendered card of several posts,
+    fetching the cached fragments with one get_many and
+    rendering and caching the missing ones. Fragments are
+    keyed by post and version, so cards must not depend
+    on the user viewing them.
+    """
+    keys = make_key_many([('post_fragment', post.pk) for post in posts])
+    keys = {pk: '{key}:{template}'.format(key=key, template=template_name) for (key_type, pk), key in keys.items()}
+    cached = cache_get_many('post_fragment', keys.values())
+    cards = {}
+    missing = []
+    for post in posts:
+        if keys[post.pk] in cached:
+            cards[post.pk] = cache_value(cached[keys[post.pk]])
+        else:
+            missing.append(post)
+    if missing:
+        card_template = get_template(template_name)
+        request = context.get('request')
+        fragments = {}
+        for post in missing:
+            card = card_template.render({'post': post, 'posts': missing, 'request': request}, request)
+            fragments[keys[post.pk]] = cards[post.pk] = card
+        cache_store_many(fragments, cache_timeout('post_fragment'))
+    return cards
+
+
+@register.simple_tag(takes_context=True)
+def post_card(context, post, template_name='post_card.html'):
+    """
+    Simple tag to display the cached card of one post.
+    """
+    memo = _memo(context, 'post_card')
+    if (post.pk, template_name) not in memo:
+        cards = _render_post_cards(context, _page_posts(context, post), template_name)
+        memo.update({(pk, template_name): card for pk, card in cards.items()})
+    card = memo[(post.pk, template_name)]
+    return mark_safe(card)
@@ -1,3 +1,938 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import routers, views
+from .concurrency import run_sync
+from .caches import (
+    _version_key, cache_bust, cache_bust_many, cache_store, cache_value, cached_read, make_key, make_key_many,
+)
+from .forms import PostForm
+from .managers import TimelineManager
+from .media import _record_variants
+from .models import Comment, Post, Timeline
+from .pagination import decode_cursor, encode_cursor
+from .search_processors import QueuedSignalProcessor
+from .signals import follow_changed
+from .templatetags.timeline_tags import post_card
 
 # Create your tests here.
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'timeline-tests',
+    },
+}
+
+
+def create_post(author, minutes=0):
+    """
+    Create a post some minutes ago with its timeline entry.
+    """
+    created = timezone.now() - datetime.timedelta(minutes=minutes)
+    post = Post.objects.create(author=author, body='Body.', created=created)
+    Timeline.objects.bulk_add_to_timeline([post])
+    return post
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheKeysTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_bust_changes_the_key_of_the_group(self):
+        comments, approved = make_key('comments', 1), make_key('approved_comments', 1)
+        cache_bust([('comments', 1)])
+        self.assertNotEqual(make_key('comments', 1), comments)
+        self.assertNotEqual(make_key('approved_comments', 1), approved)
+
+    def test_bust_leaves_other_keys(self):
+        other = make_key('comments', 2)
+        cache_bust([('comments', 1)])
+        self.assertEqual(make_key('comments', 2), other)
+
+    def test_lost_generation_does_not_resurrect_stale_values(self):
+        with mock.patch('timeline.caches.time.time', return_value=1000.0):
+            key = make_key('comments', 1)
+        cache.set(key, 'stale')
+        cache_bust([('comments', 1)])
+        cache.delete(_version_key('comments', 1))
+        with mock.patch('timeline.caches.time.time', return_value=2000.0):
+            self.assertIsNone(cache.get(make_key('comments', 1)))
+
+    def test_bust_many_within_the_same_millisecond(self):
+        with mock.patch('timeline.caches.time.time', return_value=1000.0):
+            keys = [make_key('posts_timeline', 1)]
+            for n in range(2):
+                cache_bust_many([('posts_timeline', 1)])
+                keys.append(make_key('posts_timeline', 1))
+        self.assertEqual(len(set(keys)), 3)
+
+    def test_bust_many_busts_a_shared_generation_once(self):
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as set_many:
+            cache_bust_many([('comments', 1), ('approved_comments', 1)])
+        self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(len(set_many.call_args[0][0]), 4)
+
+    @override_settings(TIMELINE_CACHE_BUST_BATCH_SIZE=2)
+    def test_bust_many_in_batches(self):
+        keys = make_key_many([('posts_timeline', pk) for pk in range(3)])
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as set_many:
+            cache_bust_many([('posts_timeline', pk) for pk in range(3)])
+        self.assertEqual([len(call[0][0]) for call in set_many.call_args_list], [2] * 6)
+        for pk in range(3):
+            self.assertNotEqual(make_key('posts_timeline', pk), keys[('posts_timeline', pk)])
+
+    def test_make_key_many_matches_make_key(self):
+        make_key('comments', 1)
+        cache_bust([('comments', 1)])
+        keys = make_key_many([('comments', 1), ('comments', 2), ('feed', 1)])
+        self.assertEqual(keys[('comments', 1)], make_key('comments', 1))
+        self.assertEqual(keys[('comments', 2)], make_key('comments', 2))
+        self.assertEqual(keys[('feed', 1)], make_key('feed', 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TIMELINE_CACHE_LOCK_WAIT=0)
+class CachedReadTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.key = make_key('comments', 1)
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return 'fresh'
+
+    def test_miss_computes_once(self):
+        self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'fresh')
+        self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'fresh')
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(cache.get('{key}:lock'.format(key=self.key)))
+
+    def test_expired_value_is_recomputed(self):
+        cache.set(self.key, ('stale', time.time() - 1, 0.0))
+        self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'fresh')
+        self.assertEqual(cache_value(cache.get(self.key)), 'fresh')
+
+    def test_stale_value_is_served_while_locked(self):
+        cache.set(self.key, ('stale', time.time() - 1, 0.0))
+        cache.add('{key}:lock'.format(key=self.key), True)
+        self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'stale')
+        self.assertEqual(self.calls, 0)
+
+    def test_miss_computes_after_the_lock_wait(self):
+        cache.add('{key}:lock'.format(key=self.key), True)
+        self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'fresh')
+        self.assertEqual(self.calls, 1)
+
+    def test_early_expiration(self):
+        cache_store(self.key, 'cached', 10, delta=5.0)
+        with mock.patch('timeline.caches.random.random', return_value=0.0):
+            self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'cached')
+        with mock.patch('timeline.caches.random.random', return_value=1.0 - 1e-12):
+            self.assertEqual(cached_read('comments', self.key, self.compute, 60), 'fresh')
+        self.assertEqual(self.calls, 1)
+
+    def test_values_without_timeout_never_expire_early(self):
+        cache_store(self.key, 'cached', None, delta=5.0)
+        with mock.patch('timeline.caches.random.random', return_value=1.0 - 1e-12):
+            self.assertEqual(cached_read('comments', self.key, self.compute, None), 'cached')
+
+
+class PaginationTests(SimpleTestCase):
+
+    def test_cursor_round_trip(self):
+        created = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(created, 42)), (created, 42))
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor(timezone.now(), 42)
+        self.assertNotIn('=', cursor)
+        self.assertRegex(cursor, r'^[A-Za-z0-9_-]+$')
+
+    def test_invalid_cursors(self):
+        for cursor in ('', 'not a cursor', encode_cursor(timezone.now(), 1)[:-4]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentCountersTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.post = Post.objects.create(author=self.user, body='Body.', created=timezone.now())
+        for approved in (True, True, False):
+            Comment.objects.create(post=self.post, author=self.user, text='Comment.', approved=approved)
+
+    def test_recount_comments(self):
+        Post.objects.filter(pk=self.post.pk).update(
+            comments_count=10, approved_comments_count=0, disapproved_comments_count=7)
+        self.assertEqual(Post.objects.recount_comments([self.post.pk]), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 3)
+        self.assertEqual(self.post.approved_comments_count, 2)
+        self.assertEqual(self.post.disapproved_comments_count, 1)
+
+    def test_recount_posts_without_comments(self):
+        post = Post.objects.create(author=self.user, body='Body.', created=timezone.now() - datetime.timedelta(days=1))
+        Post.objects.filter(pk=post.pk).update(comments_count=5)
+        Post.objects.recount_comments([post.pk])
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 0)
+
+    def test_update_comments_count(self):
+        Post.objects.recount_comments([self.post.pk])
+        Post.objects.update_comments_count(self.post, approved=-1, disapproved=1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 3)
+        self.assertEqual(self.post.approved_comments_count, 1)
+        self.assertEqual(self.post.disapproved_comments_count, 2)
+
+    def test_delete_decrements_the_stored_approval(self):
+        Post.objects.recount_comments([self.post.pk])
+        comment = Comment.objects.filter(post=self.post, approved=True).first()
+        # A concurrent moderation left the instance stale.
+        Comment.objects.filter(pk=comment.pk).update(approved=False)
+        Post.objects.update_comments_count(self.post, approved=-1, disapproved=1)
+        comment.delete(user=self.user)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.approved_comments_count, 1)
+        self.assertEqual(self.post.disapproved_comments_count, 1)
+        self.assertEqual(self.post.comments_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FollowSignalsTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_follow_change_busts_the_follower(self):
+        keys = make_key_many([('timeline', 1), ('posts_timeline', 1), ('timeline_bucket', 1), ('posts', 1),
+                              ('timeline', 2)])
+        follow_changed(sender=None, instance=mock.Mock(follower_id=1, followee_id=2))
+        for key_type in ('timeline', 'posts_timeline', 'timeline_bucket'):
+            self.assertNotEqual(make_key(key_type, 1), keys[(key_type, 1)])
+        self.assertEqual(make_key('posts', 1), keys[('posts', 1)])
+        self.assertEqual(make_key('timeline', 2), keys[('timeline', 2)])
+
+    @override_settings(TIMELINE_FANOUT=True)
+    def test_follow_change_drops_the_feed(self):
+        cache.set(make_key('feed', 1), [])
+        follow_changed(sender=None, instance=mock.Mock(follower_id=1, followee_id=2))
+        self.assertIsNone(cache.get(make_key('feed', 1)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GetTimelinesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(username='user{n}'.format(n=n)) for n in range(3)]
+        self.posts = {user.pk: [create_post(user, minutes) for minutes in (30 + user.pk, 10 + user.pk)]
+                      for user in self.users}
+        followees = {self.users[0].pk: [self.users[1].pk]}
+        for name, side_effect in (
+                ('_followees', lambda user: followees.get(user.pk, [])),
+                ('_followees_many', lambda users: {user.pk: followees.get(user.pk, []) for user in users})):
+            patcher = mock.patch.object(TimelineManager, name, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_timelines_merge_the_followees(self):
+        timelines = Timeline.objects.get_timelines(self.users, 'post')
+        posts = sorted(self.posts[self.users[0].pk] + self.posts[self.users[1].pk], key=lambda post: post.created)
+        self.assertEqual(timelines[self.users[0].pk], [post.pk for post in reversed(posts)])
+        self.assertEqual(timelines[self.users[2].pk], [post.pk for post in reversed(self.posts[self.users[2].pk])])
+
+    def test_timelines_match_get_timeline(self):
+        timelines = Timeline.objects.get_timelines(self.users, 'post')
+        cache.clear()
+        for user in self.users:
+            self.assertEqual(timelines[user.pk], Timeline.objects.get_timeline('post', user))
+
+    @override_settings(TIMELINE_BULK_CHUNK_SIZE=2)
+    def test_timelines_are_built_in_chunks(self):
+        with mock.patch.object(Timeline.objects, '_get_timelines_chunk',
+                               wraps=Timeline.objects._get_timelines_chunk) as chunk:
+            timelines = Timeline.objects.get_timelines(iter(self.users), 'post')
+        self.assertEqual([len(call[0][0]) for call in chunk.call_args_list], [2, 1])
+        self.assertEqual(set(timelines), {user.pk for user in self.users})
+
+    def test_cached_timelines_are_reused(self):
+        timelines = Timeline.objects.get_timelines(self.users, 'post')
+        with self.assertNumQueries(0):
+            self.assertEqual(Timeline.objects.get_timelines(self.users, 'post'), timelines)
+
+    def test_windowed_timelines_are_not_cached(self):
+        timelines = Timeline.objects.get_timelines(self.users, 'post', last_days=1)
+        self.assertEqual(len(timelines[self.users[0].pk]), 4)
+        self.assertIsNone(cache.get(make_key('timeline', self.users[0].pk)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FollowerBustTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User(pk=1, username='author')
+        self.followers = [2, 3]
+        self.keys = make_key_many([(key_type, pk) for pk in [1] + self.followers
+                                   for key_type in ('posts', 'timeline', 'posts_timeline', 'timeline_bucket')])
+        for name, value in (('_followers', self.followers), ('_followers_count', len(self.followers))):
+            patcher = mock.patch.object(TimelineManager, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def busted(self, key_type, pk):
+        return make_key(key_type, pk) != self.keys[(key_type, pk)]
+
+    def test_followers_timelines_are_busted(self):
+        Timeline.objects.bust_followers(user=self.author)
+        for pk in self.followers:
+            self.assertTrue(self.busted('timeline', pk))
+            self.assertTrue(self.busted('posts_timeline', pk))
+            self.assertFalse(self.busted('timeline_bucket', pk))
+            self.assertFalse(self.busted('posts', pk))
+        self.assertFalse(self.busted('timeline', 1))
+
+    def test_history_busts_the_day_buckets(self):
+        Timeline.objects.bust_followers(user=self.author, key_type='followees_history')
+        for pk in self.followers:
+            self.assertTrue(self.busted('timeline_bucket', pk))
+            self.assertFalse(self.busted('posts', pk))
+
+    def test_fetched_followers_are_not_fetched_again(self):
+        Timeline.objects.bust_followers(user=self.author, followers=[2])
+        self.assertFalse(TimelineManager._followers.called)
+        self.assertFalse(TimelineManager._followers_count.called)
+        self.assertTrue(self.busted('timeline', 2))
+        self.assertFalse(self.busted('timeline', 3))
+
+    @override_settings(TIMELINE_INVALIDATION_SYNC_LIMIT=1)
+    def test_many_followers_are_busted_in_the_background(self):
+        with mock.patch('timeline.managers.cache_bust_async') as bust_async:
+            Timeline.objects.bust_followers(user=self.author)
+        self.assertFalse(TimelineManager._followers.called)
+        self.assertFalse(self.busted('timeline', 2))
+        cache_types = bust_async.call_args[0][0]
+        self.assertEqual(sorted(cache_types()), [('followees', 2), ('followees', 3)])
+
+    def test_bust_timelines_leaves_the_followers_posts(self):
+        with mock.patch.object(TimelineManager, '_followers_many', return_value={2, 3}):
+            Timeline.objects.bust_timelines([1])
+        self.assertTrue(self.busted('posts', 1))
+        self.assertTrue(self.busted('timeline_bucket', 1))
+        for pk in self.followers:
+            self.assertTrue(self.busted('timeline', pk))
+            self.assertTrue(self.busted('timeline_bucket', pk))
+            self.assertFalse(self.busted('posts', pk))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TIMELINE_FANOUT=True)
+class FanoutTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='author')
+        self.follower = User.objects.create(username='follower')
+        self.old = create_post(self.author, minutes=60)
+        followees = {self.follower.pk: [self.author.pk]}
+        for name, side_effect in (
+                ('_followees', lambda user: followees.get(user.pk, [])),
+                ('_followers', lambda user: [self.follower.pk] if user == self.author else []),
+                ('_followers_count', lambda user: 1 if user == self.author else 0)):
+            patcher = mock.patch.object(TimelineManager, name, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def publish(self, minutes=0):
+        post = Post.objects.create(author=self.author, body='Body.',
+                                   created=timezone.now() - datetime.timedelta(minutes=minutes))
+        Timeline.objects.add_to_timeline(instance=post, user=self.author)
+        return post
+
+    def test_new_entries_are_pushed_to_materialized_feeds(self):
+        self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [self.old.pk])
+        post = self.publish()
+        with self.assertNumQueries(0):
+            self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [post.pk, self.old.pk])
+        entries, pull_authors, generation = cache.get(make_key('feed', self.follower.pk))
+        self.assertEqual([object_id for date, object_id, ctype_id in entries], [self.old.pk, post.pk])
+
+    def test_feed_reads_do_not_fetch_followees(self):
+        Timeline.objects.get_timeline('post', self.follower)
+        self.assertEqual(TimelineManager._followees.call_count, 1)
+        Timeline.objects.get_timeline('post', self.follower)
+        self.assertEqual(TimelineManager._followees.call_count, 1)
+
+    @override_settings(TIMELINE_FANOUT_LENGTH=2)
+    def test_feeds_are_trimmed(self):
+        Timeline.objects.get_timeline('post', self.follower)
+        posts = [self.publish(minutes) for minutes in (30, 20, 10)]
+        entries, pull_authors, generation = cache.get(make_key('feed', self.follower.pk))
+        self.assertEqual([object_id for date, object_id, ctype_id in entries], [posts[1].pk, posts[2].pk])
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0)
+    def test_authors_with_many_followers_are_pulled(self):
+        Timeline.objects.get_timeline('post', self.follower)
+        post = self.publish()
+        entries, pull_authors, generation = cache.get(make_key('feed', self.follower.pk))
+        self.assertEqual([object_id for date, object_id, ctype_id in entries], [self.old.pk])
+        # The new pull author refreshes the pull authors of the feed once.
+        self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [post.pk, self.old.pk])
+        self.assertEqual(TimelineManager._followees.call_count, 2)
+        self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [post.pk, self.old.pk])
+        self.assertEqual(TimelineManager._followees.call_count, 2)
+
+    def test_deleted_entries_leave_the_feeds(self):
+        post = self.publish()
+        for user in (self.author, self.follower):
+            self.assertEqual(Timeline.objects.get_timeline('post', user), [post.pk, self.old.pk])
+        post.delete(user=self.author)
+        for user in (self.author, self.follower):
+            entries, pull_authors, generation = cache.get(make_key('feed', user.pk))
+            self.assertEqual([object_id for date, object_id, ctype_id in entries], [self.old.pk])
+            self.assertEqual(Timeline.objects.get_timeline('post', user), [self.old.pk])
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0)
+    def test_deleted_entries_of_pulled_authors(self):
+        post = self.publish()
+        self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [post.pk, self.old.pk])
+        self.old.delete(user=self.author)
+        self.assertEqual(Timeline.objects.get_timeline('post', self.follower), [post.pk])
+        self.assertEqual(Timeline.objects.get_timeline('post', self.author), [post.pk])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TimelinePageTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.posts = [create_post(self.user, minutes) for minutes in (50, 40, 30, 20, 10)]
+        self.factory = RequestFactory()
+
+    def pages(self, limit=2, get_page=None):
+        get_page = get_page or (lambda cursor: Timeline.objects.get_timeline_page(
+            'post', self.user, cursor=cursor, limit=limit))
+        cursor, pages = None, []
+        while True:
+            page, cursor = get_page(cursor)
+            pages.append(page)
+            if cursor is None:
+                return pages
+
+    def expected(self, limit=2):
+        ids = [post.pk for post in reversed(self.posts)]
+        return [ids[start:start + limit] for start in range(0, len(ids), limit)]
+
+    def test_pages_from_the_cached_timeline(self):
+        self.assertEqual(self.pages(), self.expected())
+
+    def test_pages_from_queries(self):
+        query = Timeline.objects._get_query('post', self.user, None)
+        pages = self.pages(get_page=lambda cursor: Timeline.objects._timeline_page(query, cursor, 2))
+        self.assertEqual(pages, self.expected())
+
+    @override_settings(TIMELINE_FANOUT=True, TIMELINE_FANOUT_LENGTH=3)
+    def test_pages_from_a_truncated_feed(self):
+        self.assertEqual(self.pages(), self.expected())
+
+    def test_full_pages_have_a_next_cursor(self):
+        page, cursor = Timeline.objects.get_timeline_page('post', self.user, limit=5)
+        self.assertEqual(cursor, (self.posts[0].created, self.posts[0].pk))
+        page, cursor = Timeline.objects.get_timeline_page('post', self.user, cursor=cursor, limit=5)
+        self.assertEqual((page, cursor), ([], None))
+
+    def test_missing_last_entry_of_a_cached_page(self):
+        Timeline.objects.get_timeline('post', self.user)
+        # Deleted without busting the cached timeline.
+        Post.objects.filter(pk=self.posts[3].pk).delete()
+        page, cursor = Timeline.objects.get_timeline_page('post', self.user, limit=2)
+        self.assertEqual(page, [self.posts[4].pk, self.posts[2].pk])
+        self.assertEqual(cursor, (self.posts[2].created, self.posts[2].pk))
+
+    def show_page(self, **params):
+        request = self.factory.get('/', params)
+        request.user = self.user
+        with mock.patch('timeline.views.render', return_value=HttpResponse()) as render:
+            response = views.show_posts_timeline(request)
+        return response, render.call_args[0][2] if render.called else None
+
+    @override_settings(TIMELINE_PAGE_SIZE=3)
+    def test_view_pages_past_missing_posts(self):
+        Timeline.objects.get_timeline('post', self.user)
+        Post.objects.filter(pk=self.posts[3].pk).delete()
+        response, context = self.show_page()
+        self.assertEqual([post.pk for post in context['posts']], [self.posts[4].pk, self.posts[2].pk])
+        self.assertIsNotNone(context['next_cursor'])
+        response, context = self.show_page(cursor=context['next_cursor'])
+        self.assertEqual([post.pk for post in context['posts']], [self.posts[1].pk, self.posts[0].pk])
+        self.assertIsNone(context['next_cursor'])
+
+    def test_view_rejects_malformed_cursors(self):
+        response, context = self.show_page(cursor='not a cursor')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TIMELINE_PAGE_SIZE=2)
+class TimelineSinceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.posts = [create_post(self.user, minutes) for minutes in (30, 20, 10)]
+        self.factory = RequestFactory()
+
+    def poll(self, **params):
+        request = self.factory.get('/', params)
+        request.user = self.user
+        response = views.show_posts_timeline_since(request)
+        if response.status_code != 200:
+            return response, None
+        return response, json.loads(response.content.decode('utf-8'))
+
+    def test_first_poll_returns_the_newest_posts(self):
+        for params in ({}, {'since': ''}):
+            response, content = self.poll(**params)
+            self.assertEqual([post['pk'] for post in content['posts']], [self.posts[1].pk, self.posts[2].pk])
+            self.assertEqual(decode_cursor(content['cursor']), (self.posts[2].created, self.posts[2].pk))
+
+    def test_poll_returns_the_newer_posts_oldest_first(self):
+        since = encode_cursor(self.posts[0].created, self.posts[0].pk)
+        response, content = self.poll(since=since)
+        self.assertEqual([post['pk'] for post in content['posts']], [self.posts[1].pk, self.posts[2].pk])
+        response, content = self.poll(since=content['cursor'])
+        self.assertEqual(content['posts'], [])
+        post = create_post(self.user)
+        response, content = self.poll(since=content['cursor'])
+        self.assertEqual([item['pk'] for item in content['posts']], [post.pk])
+
+    def test_poll_rejects_malformed_cursors(self):
+        response, content = self.poll(since='not a cursor')
+        self.assertEqual(response.status_code, 400)
+
+
+class CollectMediaTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.user = User.objects.create(username='author')
+
+    def touch(self, name):
+        path = os.path.join(self.media_root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+        return path
+
+    def collect(self, **options):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            call_command('timeline_collect_media', min_age=0, stdout=io.StringIO(), **options)
+
+    def test_removes_only_orphaned_images(self):
+        orphan = self.touch('author/images/posts/orphan.jpg')
+        relative = self.touch('author/images/posts/relative.jpg')
+        absolute = self.touch('author/images/posts/absolute.jpg')
+        Post.objects.filter(pk=create_post(self.user).pk).update(image='author/images/posts/relative.jpg')
+        Post.objects.filter(pk=create_post(self.user).pk).update(image=absolute)
+        self.collect()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(relative))
+        self.assertTrue(os.path.exists(absolute))
+
+    def test_removes_orphaned_variants(self):
+        orphan = self.touch('variants/ab/cd/abcd-thumbnail.jpg')
+        kept = self.touch('variants/ef/01/ef01-medium.jpg')
+        Post.objects.filter(pk=create_post(self.user).pk).update(image_medium='variants/ef/01/ef01-medium.jpg')
+        self.collect()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(kept))
+
+    def test_dry_run_keeps_the_files(self):
+        orphan = self.touch('author/images/posts/orphan.jpg')
+        self.collect(dry_run=True)
+        self.assertTrue(os.path.exists(orphan))
+
+    def test_prunes_only_emptied_post_trees(self):
+        self.touch('author/images/posts/orphan.jpg')
+        os.makedirs(os.path.join(self.media_root, 'empty'))
+        os.makedirs(os.path.join(self.media_root, 'other', 'images', 'posts'))
+        self.touch('other/avatar.jpg')
+        self.collect()
+        self.assertEqual(sorted(os.listdir(self.media_root)), ['empty', 'other'])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'other')), ['avatar.jpg'])
+
+
+class SearchQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        connection = mock.Mock()
+        connection.get_backend.return_value = self.backend
+        router = mock.Mock()
+        router.for_write.return_value = ['default']
+        self.processor = QueuedSignalProcessor({'default': connection}, router)
+        self.addCleanup(self.processor.teardown)
+
+    def test_flush_applies_the_last_change_per_post(self):
+        self.processor._pending = {1: None, 2: 'timeline.post.2'}
+        self.processor.flush()
+        self.assertEqual(self.backend.update.call_count, 1)
+        self.backend.remove.assert_called_once_with('timeline.post.2')
+        self.assertEqual(self.processor._pending, {})
+
+    def test_flush_requeues_the_batch_on_backend_failures(self):
+        self.backend.update.side_effect = ConnectionError
+        self.processor._pending = {1: None, 2: 'timeline.post.2'}
+        with self.assertLogs('timeline.search', 'ERROR'):
+            self.processor.flush()
+        self.assertEqual(self.processor._pending, {1: None, 2: 'timeline.post.2'})
+
+    def test_requeued_changes_do_not_override_newer_ones(self):
+        def update(*args):
+            self.processor._pending[1] = 'timeline.post.1'
+            raise ConnectionError
+
+        self.backend.update.side_effect = update
+        self.processor._pending = {1: None}
+        with self.assertLogs('timeline.search', 'ERROR'):
+            self.processor.flush()
+        self.assertEqual(self.processor._pending, {1: 'timeline.post.1'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TIMELINE_READ_REPLICAS=['replica1', 'replica2'])
+class ReplicaRoutingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.addCleanup(routers.end_request)
+
+    def test_request_reads_from_one_replica(self):
+        routers.start_request(self.user)
+        replica = routers.read_alias()
+        self.assertIn(replica, ['replica1', 'replica2'])
+        self.assertEqual({routers.read_alias() for i in range(20)}, {replica})
+
+    def test_pinned_user_reads_from_the_primary(self):
+        routers.pin_to_primary(self.user)
+        self.assertEqual(routers.read_alias(), 'default')
+        routers.end_request()
+        routers.start_request(self.user)
+        self.assertEqual(routers.read_alias(), 'default')
+
+    def test_end_request_resets_the_pin(self):
+        routers.start_request(self.user)
+        routers.pin_to_primary(self.user)
+        routers.end_request()
+        self.assertIn(routers.read_alias(), ['replica1', 'replica2'])
+
+    def test_streamed_posts_read_from_the_request_database(self):
+        create_post(self.user)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        routers.start_request(self.user)
+        replica = routers.read_alias()
+        response = views.show_posts_timeline_json(request)
+        routers.end_request()
+        with mock.patch('timeline.views.Post') as post:
+            post.objects.using.return_value.filter.return_value.values.return_value.iterator.return_value = []
+            b''.join(response.streaming_content)
+        post.objects.using.assert_called_once_with(replica)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TimelineValidatorTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.post = create_post(self.user, minutes=10)
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        request = self.factory.get('/', **headers)
+        request.user = self.user
+        return views.show_posts_timeline_json(request)
+
+    def test_unchanged_timeline_is_not_modified(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_validator_is_cached(self):
+        version = Timeline.objects.get_timeline_version(model='post', user=self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(Timeline.objects.get_timeline_version(model='post', user=self.user), version)
+
+    def test_edit_changes_the_validator(self):
+        etag = self.get()['ETag']
+        form = PostForm(instance=self.post, data={'author': self.user.pk, 'title': 'Title', 'body': 'Edited.'})
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save(user=self.user, updated=True)
+        self.assertEqual(self.post.version, 1)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_image_variants_change_the_version_only(self):
+        etag = self.get()['ETag']
+        future = mock.Mock()
+        future.result.return_value = {'thumbnail': 'variants/ab/cd/abcd-thumbnail.jpg'}
+        with mock.patch('timeline.media.connections'):
+            _record_variants(self.post.pk, future)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.version, 1)
+        self.assertIsNone(self.post.last_updated)
+        self.assertNotEqual(self.get(HTTP_IF_NONE_MATCH=etag)['ETag'], etag)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncReadTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Content types are created again after each flush.
+        self.clear_content_types()
+        self.addCleanup(self.clear_content_types)
+        self.user = User.objects.create(username='author')
+        self.posts = [create_post(self.user, minutes) for minutes in (20, 10)]
+        Comment.objects.create(post=self.posts[0], author=self.user, text='Comment.')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def clear_content_types(self):
+        ContentType.objects.clear_cache()
+        apps.get_app_config('timeline')._content_types = None
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_async_reads_match_the_sync_ones(self):
+        page = Timeline.objects.get_timeline_page(model='post', user=self.user)
+        self.assertEqual(self.run_async(Timeline.objects.aget_timeline_page(model='post', user=self.user)), page)
+        timeline = Timeline.objects.get_timeline(model='post', user=self.user)
+        self.assertEqual(self.run_async(Timeline.objects.aget_timeline(model='post', user=self.user)), timeline)
+        comments = self.run_async(Comment.objects.acomments(self.posts[0]))
+        self.assertEqual(comments, Comment.objects.comments(self.posts[0]))
+
+    def test_posts_timeline_page(self):
+        posts, comments, version, next_cursor = self.run_async(
+            Timeline.objects.aget_posts_timeline_page(user=self.user, limit=1))
+        self.assertEqual(posts, [self.posts[1]])
+        self.assertEqual(comments, {self.posts[1].pk: []})
+        self.assertEqual(version, Timeline.objects.get_timeline_version(model='post', user=self.user))
+        self.assertEqual(next_cursor, (self.posts[1].created, self.posts[1].pk))
+
+    @override_settings(TIMELINE_READ_REPLICAS=['replica'])
+    def test_worker_threads_read_from_the_caller_database(self):
+        routers.start_request(self.user)
+        routers.pin_to_primary(self.user)
+        self.addCleanup(routers.end_request)
+        self.assertEqual(self.run_async(run_sync(routers.read_alias)), 'default')
+        routers.end_request()
+        self.assertEqual(self.run_async(run_sync(routers.read_alias)), 'replica')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DayBucketTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.posts = [create_post(self.user, minutes) for minutes in (60 * 24 * 3, 60 * 24, 0)]
+
+    def test_timeline_of_the_last_days(self):
+        timeline = Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        self.assertEqual(timeline, [self.posts[2].pk, self.posts[1].pk])
+
+    def test_buckets_are_cached(self):
+        timeline = Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(Timeline.objects.get_timeline(model='post', user=self.user, last_days=2), timeline)
+
+    def test_new_posts_only_query_the_current_day(self):
+        Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        post = Post.objects.create(author=self.user, body='Body.')
+        Timeline.objects.add_to_timeline(instance=post, user=self.user)
+        with mock.patch.object(TimelineManager, 'filter', wraps=Timeline.objects.filter) as query:
+            timeline = Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        self.assertEqual(timeline, [post.pk, self.posts[2].pk, self.posts[1].pk])
+        self.assertEqual(query.call_count, 1)
+        today = Timeline.objects._bucket_start(Timeline.objects._bucket(timezone.now()))
+        self.assertIn(repr(('date__gte', today)), str(query.call_args))
+
+    def test_closed_buckets_are_busted_with_past_entries(self):
+        Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        Timeline.objects.filter(object_id=self.posts[1].pk).delete()
+        Post.objects.filter(pk=self.posts[1].pk).delete()
+        self.assertIn(self.posts[1].pk, Timeline.objects.get_timeline(model='post', user=self.user, last_days=2))
+        cache_bust([('timeline_bucket', self.user.pk)])
+        timeline = Timeline.objects.get_timeline(model='post', user=self.user, last_days=2)
+        self.assertEqual(timeline, [self.posts[2].pk])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.now = timezone.now()
+
+    def records(self, count):
+        for n in range(count):
+            yield {'author_id': self.user.pk, 'body': 'Body {n}.'.format(n=n),
+                   'created': self.now - datetime.timedelta(minutes=n)}
+
+    def test_imports_posts_to_the_timeline(self):
+        with mock.patch.object(TimelineManager, 'bust_timelines') as bust_timelines:
+            self.assertEqual(Post.objects.bulk_import(self.records(5), chunk_size=2), 5)
+        bust_timelines.assert_called_once_with({self.user.pk})
+        posts = list(Post.objects.order_by('-created').values_list('pk', flat=True))
+        self.assertEqual(len(set(posts)), 5)
+        self.assertEqual(Timeline.objects.get_timeline(model='post', user=self.user), posts)
+
+    def test_committed_chunks_are_busted_on_failures(self):
+        def records():
+            yield from self.records(2)
+            raise ValueError
+
+        with mock.patch.object(TimelineManager, 'bust_timelines') as bust_timelines:
+            with self.assertRaises(ValueError):
+                Post.objects.bulk_import(records(), chunk_size=2)
+        self.assertEqual(Post.objects.count(), 2)
+        bust_timelines.assert_called_once_with({self.user.pk})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ModerationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='author')
+        self.commenter = User.objects.create(username='commenter')
+        self.post = create_post(self.author)
+        self.comments = [Comment.objects.create(post=self.post, author=self.commenter, text='Comment.')
+                         for n in range(3)]
+        Post.objects.recount_comments([self.post.pk])
+
+    def assertCounts(self, approved, disapproved):
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.approved_comments_count, self.post.disapproved_comments_count),
+                         (approved, disapproved))
+        self.assertEqual(self.post.comments_count, approved + disapproved)
+
+    def test_moderate_comments_by_id(self):
+        moderated = Comment.objects.moderate('disapprove', user=self.author, comments_id=[self.comments[0].pk])
+        self.assertEqual(moderated, 1)
+        self.assertCounts(2, 1)
+        self.assertEqual(Comment.objects.moderate('disapprove', user=self.author, comments_id=[self.comments[0].pk]), 0)
+        self.assertEqual(Comment.objects.moderate('approve', user=self.author, comments_id=[self.comments[0].pk]), 1)
+        self.assertCounts(3, 0)
+
+    def test_moderate_comments_by_author(self):
+        self.assertEqual(Comment.objects.moderate('delete', user=self.author, author=self.commenter), 3)
+        self.assertCounts(0, 0)
+        self.assertEqual(Comment.objects.comments(self.post), [])
+
+    def test_only_the_post_author_or_staff_moderate(self):
+        self.assertEqual(Comment.objects.moderate('delete', user=self.commenter, author=self.commenter), 0)
+        self.commenter.is_staff = True
+        self.assertEqual(Comment.objects.moderate('delete', user=self.commenter, author=self.commenter), 3)
+
+    def test_unknown_action_is_rejected(self):
+        with self.assertRaises(ValidationError):
+            Comment.objects.moderate('publish', user=self.author, author=self.commenter)
+
+    def test_view_rejects_malformed_input(self):
+        for data in ({'action': 'delete', 'comment_id': 'x'}, {'action': 'publish', 'author': 'commenter'}):
+            request = RequestFactory().post('/', data)
+            request.user = self.author
+            self.assertEqual(views.moderate_comments(request).status_code, 400)
+        self.assertCounts(3, 0)
+
+
+class FeedTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.followee = User.objects.create(username='followee')
+        self.stranger = User.objects.create(username='stranger')
+        self.posts = [create_post(author, minutes) for author, minutes in
+                      ((self.user, 40), (self.followee, 30), (self.stranger, 20), (self.followee, 10))]
+
+    def test_feed_pages_merge_the_followees(self):
+        with mock.patch.object(TimelineManager, '_followees', return_value=[self.followee.pk]):
+            feed, next_cursor = Timeline.objects.get_feed(user=self.user, limit=2)
+            self.assertEqual(feed, [self.posts[3], self.posts[1]])
+            feed, next_cursor = Timeline.objects.get_feed(user=self.user, cursor=next_cursor, limit=2)
+            self.assertEqual(feed, [self.posts[0]])
+        self.assertIsNone(next_cursor)
+
+    def test_feed_skips_missing_instances(self):
+        ctype = ContentType.objects.get_for_model(Post)
+        Timeline.objects.create(content_type=ctype, object_id=0, user=self.user, date=timezone.now())
+        feed, next_cursor = Timeline.objects.get_feed(user=self.user, limit=2)
+        self.assertEqual(feed, [self.posts[0]])
+        self.assertIsNotNone(next_cursor)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PostCardTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='author')
+        self.posts = [create_post(self.user, minutes) for minutes in (20, 10)]
+        card = engines['django'].from_string('{{ post.pk }}:{{ post.body }}')
+        patcher = mock.patch('timeline.templatetags.timeline_tags.get_template', return_value=card)
+        self.get_template = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self):
+        request = RequestFactory().get('/')
+        context = {'request': request, 'posts': self.posts}
+        return [post_card(context, post) for post in self.posts]
+
+    def test_cards_are_rendered_once_per_page(self):
+        self.assertEqual(self.render(), ['{pk}:Body.'.format(pk=post.pk) for post in self.posts])
+        self.assertEqual(self.get_template.call_count, 1)
+
+    def test_cards_are_cached(self):
+        cards = self.render()
+        Post.objects.update(body='Edited.')
+        self.posts = list(Post.objects.filter(pk__in=[post.pk for post in self.posts]).order_by('created'))
+        self.assertEqual(self.render(), cards)
+        self.assertEqual(self.get_template.call_count, 1)
+
+    def test_busted_cards_are_rendered_again(self):
+        self.render()
+        Post.objects.update(body='Edited.')
+        self.posts = list(Post.objects.filter(pk__in=[post.pk for post in self.posts]).order_by('created'))
+        cache_bust([('comments', self.posts[0].pk)])
+        self.assertEqual(self.render(), ['{pk}:Edited.'.format(pk=self.posts[0].pk),
+                                         '{pk}:Body.'.format(pk=self.posts[1].pk)])
@@ -10,6 +10,16 @@ urlpatterns = [
         view=views.show_posts_timeline,
         name='timeline_post',
     ),
+    url(
+        regex=r'^json/$',
+        view=views.show_posts_timeline_json,
+        name='timeline_post_json',
+    ),
+    url(
+        regex=r'^json/since/$',
+        view=views.show_posts_timeline_since,
+        name='timeline_post_since',
+    ),
     url(
         regex=r'^post/add/$',
         view=views.add_post,
@@ -45,4 +55,14 @@ urlpatterns = [
         view=views.delete_comment_from_post,
         name='delete_comment',
     ),
+    url(
+        regex=r'^post/comment/moderate/$',
+        view=views.moderate_comments,
+        name='moderate_comments',
+    ),
+    url(
+        regex=r'^metrics/$',
+        view=views.show_metrics,
+        name='metrics',
+    ),
 ]
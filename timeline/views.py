@@ -1,15 +1,64 @@
+import json
+
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_list_or_404, get_object_or_404, redirect, render
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 
+from . import metrics
 from .forms import CommentForm, PostForm
 from .models import Comment, Post, Timeline
+from .pagination import decode_cursor, encode_cursor, page_size
+from .routers import pin_to_primary, read_alias
 
 # Create your views here.
 
+POST_JSON_FIELDS = ('pk', 'title', 'body', 'image_thumbnail', 'created', 'last_updated', 'author__username')
+
+
+def _timeline_version(request):
+    version = getattr(request, '_timeline_version', None)
+    if version is None:
+        version = Timeline.objects.get_timeline_version(model='post', user=request.user)
+        request._timeline_version = version
+    return version
+
+
+def _timeline_etag(request, *args, **kwargs):
+    latest, count, updated, version = _timeline_version(request)
+    if latest is None:
+        return None
+    return '{user}-{latest}-{count}-{version}'.format(
+        user=request.user.pk, latest=latest.timestamp(), count=count, version=version)
+
+
+def _timeline_last_modified(request, *args, **kwargs):
+    latest, count, updated, version = _timeline_version(request)
+    if updated is not None and latest is not None:
+        return max(latest, updated)
+    return latest
+
+
+def _stream_posts(timeline, using, chunk_size=500):
+    yield '{"posts": ['
+    separator = ''
+    for start in range(0, len(timeline), chunk_size):
+        chunk = timeline[start:start + chunk_size]
+        posts = Post.objects.using(using).filter(pk__in=chunk).values(*POST_JSON_FIELDS)
+        posts = {post['pk']: post for post in posts.iterator()}
+        for pk in chunk:
+            if pk in posts:
+                yield separator + json.dumps(posts[pk], cls=DjangoJSONEncoder)
+                separator = ','
+    yield ']}'
+
+
 @login_required(login_url='/login/')
 def add_comment_to_post(request, post_id, template='post_comment_add.html'):
     post = get_object_or_404(Post, pk=post_id)
@@ -40,6 +89,26 @@ def comment_approve_or_disapprove(request, comment_id, status):
     return redirect('timeline:read_post', post_id=comment.post.pk)
 
 
+@login_required(login_url='/login/')
+@require_http_methods(['POST'])
+def moderate_comments(request):
+    action = request.POST.get('action')
+    try:
+        comments_id = [int(pk) for pk in request.POST.getlist('comment_id')] or None
+    except ValueError:
+        return HttpResponseBadRequest('Invalid comment id.')
+    author = None
+    if request.POST.get('author'):
+        author = get_object_or_404(User, username=request.POST['author'])
+    try:
+        moderated = Comment.objects.moderate(action, user=request.user, comments_id=comments_id, author=author)
+    except ValidationError:
+        return HttpResponseBadRequest('Unknown moderation action.')
+    pin_to_primary(request.user)
+    messages.success(request, '{moderated} comments moderated.'.format(moderated=moderated))
+    return redirect('timeline:timeline_post')
+
+
 @login_required(login_url='/login/')
 def delete_comment_from_post(request, comment_id, template='post_comment_delete.html'):
     comment = get_object_or_404(Comment, pk=comment_id)
@@ -70,6 +139,15 @@ def edit_post(request, post_id, template='post_add_edit.html'):
     return render(request, template, {'form': form, 'post': post})
 
 
+@staff_member_required
+@require_http_methods(['GET'])
+def show_metrics(request):
+    registry = metrics.registry()
+    if registry is None:
+        raise Http404('Metrics registry is not enabled.')
+    return JsonResponse(registry.snapshot())
+
+
 @login_required(login_url='/login/')
 @require_http_methods(['GET'])
 def read_post(request, post_id, template='post_read.html'):
@@ -80,6 +158,48 @@ def read_post(request, post_id, template='post_read.html'):
 @login_required(login_url='/login/')
 @require_http_methods(['GET'])
 def show_posts_timeline(request, template='post_timeline.html'):
-    timeline = Timeline.objects.get_timeline(model='post', user=request.user)
-    posts = Post.objects.get_posts_timeline(user=request.user, timeline=timeline)
-    return render(request, template, {'posts': posts})
+    cursor = request.GET.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid timeline cursor.')
+    limit = page_size()
+    timeline, next_cursor = Timeline.objects.get_timeline_page(
+        model='post', user=request.user, cursor=cursor, limit=limit)
+    posts = list(Post.objects.get_posts_page(timeline=timeline, cursor=cursor, limit=limit))
+    if next_cursor is not None:
+        # Posts may be missing from the page, so the cursor is its last entry.
+        next_cursor = encode_cursor(*next_cursor)
+    return render(request, template, {'posts': posts, 'next_cursor': next_cursor})
+
+
+@login_required(login_url='/login/')
+@require_http_methods(['GET'])
+@condition(etag_func=_timeline_etag, last_modified_func=_timeline_last_modified)
+def show_posts_timeline_json(request):
+    timeline = list(Timeline.objects.get_timeline(model='post', user=request.user))
+    # The response is streamed after the request ended, so take its database now.
+    posts = _stream_posts(timeline, using=read_alias())
+    return StreamingHttpResponse(posts, content_type='application/json')
+
+
+@login_required(login_url='/login/')
+@require_http_methods(['GET'])
+def show_posts_timeline_since(request):
+    cursor = request.GET.get('since') or None
+    if cursor is None:
+        # First poll: the newest entries and the cursor of the newest one.
+        timeline, next_cursor = Timeline.objects.get_timeline_page(model='post', user=request.user, limit=page_size())
+    else:
+        try:
+            since_date, since_pk = decode_cursor(cursor)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid timeline cursor.')
+        timeline = Timeline.objects.get_timeline_since(
+            user=request.user, model='post', since_date=since_date, since_pk=since_pk, limit=page_size())
+    posts = Post.objects.filter(pk__in=timeline).order_by('created', 'pk').values(*POST_JSON_FIELDS)
+    posts = list(posts)
+    if posts:
+        cursor = encode_cursor(posts[-1]['created'], posts[-1]['pk'])
+    return JsonResponse({'posts': posts, 'cursor': cursor})